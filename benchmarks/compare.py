@@ -0,0 +1,52 @@
+"""Compare two benchmark result files.
+
+Usage: python -m benchmarks.compare old.json new.json [--threshold 10]
+
+Exits with 1 if any timing got slower by more than the threshold (in percent).
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(data: dict, prefix='') -> dict:
+    values = {}
+    for key, value in data.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark runs')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0)
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+
+    old_values, new_values = flatten(old), flatten(new)
+    regressions = []
+    for key in sorted(old_values.keys() & new_values.keys()):
+        before, after = old_values[key], new_values[key]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f'{key}: {before} -> {after} ({change:+.1f}%)')
+        if key.endswith('median_ms') and change > args.threshold:
+            regressions.append(key)
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
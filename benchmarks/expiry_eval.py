@@ -0,0 +1,179 @@
+"""Replay a history of grid reloads against expiry policies.
+
+Record a history with EXPIRY_HISTORY_FILE set in the bot, or by polling all areas at a fixed interval:
+    python -m benchmarks.expiry_eval record history.jsonl --interval 60 --duration 86400 [--fake]
+then evaluate the policies on it:
+    python -m benchmarks.expiry_eval evaluate history.jsonl [--target 0.05 0.1 0.2]
+
+The recorded pages are taken as the truth between two records, so the finer the history, the
+better the evaluation. For every policy the replay reports the reloads it needs and how stale
+the cached grids are.
+"""
+import argparse
+import bisect
+import datetime
+import heapq
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+
+def load_history(path: str) -> dict:
+    """(date, area) -> sorted lists of times and records"""
+    groups = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                groups[(record['date'], record['area'])].append(record)
+    history = {}
+    for key, records in groups.items():
+        records.sort(key=lambda r: r['time'])
+        history[key] = ([r['time'] for r in records], records)
+    return history
+
+
+def stale_time(times: list, records: list, cached_hash: str, start: float, end: float) -> float:
+    """Seconds within [start, end) in which the recorded page differs from the cached one."""
+    stale = 0.0
+    i = max(0, bisect.bisect_right(times, start) - 1)
+    t = start
+    while t < end:
+        segment_end = min(end, times[i + 1]) if i + 1 < len(times) else end
+        if records[i]['hash'] != cached_hash:
+            stale += segment_end - t
+        t = segment_end
+        i += 1
+    return stale
+
+
+def replay(policy, history: dict) -> dict:
+    """Reload every grid whenever the policy lets it expire, in the order of time across all grids."""
+    events = []
+    state = {}
+    fetches = changed = 0
+    stale = covered = 0.0
+    expiry_times = []
+
+    def fetch(key, t):
+        nonlocal fetches, changed, stale
+        times, records = history[key]
+        record = records[bisect.bisect_right(times, t) - 1]
+        date = datetime.datetime.strptime(key[0], '%Y-%m-%d')
+        now = datetime.datetime.fromtimestamp(t)
+        if key in state:
+            cached_hash, last = state[key]
+            stale += stale_time(times, records, cached_hash, last, t)
+            is_changed = record['hash'] != cached_hash
+            changed += is_changed
+            policy.observe(date, key[1], is_changed, t - last, now)
+        fetches += 1
+        state[key] = (record['hash'], t)
+        expiry_time = policy.expiry_time(date, key[1], record['free_seats_min'], record['total_seats'], now)
+        expiry_times.append(expiry_time)
+        heapq.heappush(events, (t + expiry_time, key))
+
+    for key, (times, _) in history.items():
+        covered += times[-1] - times[0]
+        heapq.heappush(events, (times[0], key))
+    while events:
+        t, key = heapq.heappop(events)
+        times, records = history[key]
+        if t > times[-1]:
+            cached_hash, last = state[key]
+            stale += stale_time(times, records, cached_hash, last, times[-1])
+            continue
+        fetch(key, t)
+
+    return {
+        'reloads': fetches,
+        'reloads_per_grid_hour': round(fetches / covered * 3600, 2) if covered else None,
+        'changed_on_reload': round(changed / fetches, 3) if fetches else None,
+        'stale_time_share': round(stale / covered, 4) if covered else None,
+        'mean_expiry_s': round(sum(expiry_times) / len(expiry_times), 1) if expiry_times else None,
+    }
+
+
+def evaluate(args):
+    from reservations.cache import MemoryCache
+    from reservations.expiry import LadderPolicy, ChangeRatePolicy
+
+    history = load_history(args.history)
+    policies = {'ladder': lambda: LadderPolicy()}
+    for target in args.target:
+        policies[f'change-rate@{target}'] = lambda target=target: ChangeRatePolicy(
+            MemoryCache(), target=target, min_expiry=args.min_expiry, max_expiry=args.max_expiry,
+            min_observations=args.min_observations, min_exposure=args.min_exposure)
+    results = {}
+    for name, create in policies.items():
+        random.seed(args.seed)
+        results[name] = replay(create(), history)
+    print(json.dumps({'grids': len(history), 'policies': results}, indent=2))
+
+
+def record(args):
+    server = None
+    if args.fake:
+        from .fake_mrbs import FakeMRBSServer
+        server = FakeMRBSServer(churn=args.churn).start()
+        os.environ['BASE_URL'] = server.base_url
+        os.environ.pop('PROXY', None)
+        os.environ.pop('PROXIES', None)
+    base_url = os.environ.get('BASE_URL', 'https://raumbuchung.bibliothek.kit.edu/sitzplatzreservierung/')
+    from reservations.backend import Backend, get_day_url, hash_day_page, parse_room_entries
+    from reservations.expiry import record_refresh
+    from reservations.records import SeatIndex
+
+    b = Backend(base_url)
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        start = time.monotonic()
+        for day in range(args.days):
+            date = datetime.datetime.today() + datetime.timedelta(days=day)
+            for area in b.areas:
+                r = b.get_request(get_day_url(date, area))
+                index = SeatIndex.from_grid(parse_room_entries(r.text, area))
+                record_refresh(date, area, hash_day_page(r.text),
+                               min(index.free_count(daytime) for daytime in range(len(index.totals))),
+                               min(index.totals), datetime.datetime.now(), path=args.history)
+        time.sleep(max(0.0, args.interval - (time.monotonic() - start)))
+    if server:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate expiry policies on recorded grid reloads')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    evaluate_parser = commands.add_parser('evaluate', help='replay a history against the policies')
+    evaluate_parser.add_argument('history')
+    evaluate_parser.add_argument('--target', type=float, nargs='+', default=[0.05, 0.1, 0.2],
+                                 help='target staleness of the change-rate policy, several are compared')
+    evaluate_parser.add_argument('--min-expiry', type=int, default=10)
+    evaluate_parser.add_argument('--max-expiry', type=int, default=15 * 60)
+    evaluate_parser.add_argument('--min-exposure', type=float, default=30 * 60,
+                                 help='seconds observed in a bucket before the change-rate policy trusts it')
+    evaluate_parser.add_argument('--min-observations', type=int, default=5,
+                                 help='reloads in a bucket before the change-rate policy trusts it')
+    evaluate_parser.add_argument('--seed', type=int, default=0)
+
+    record_parser = commands.add_parser('record', help='poll all areas and append the reloads to a history')
+    record_parser.add_argument('history')
+    record_parser.add_argument('--interval', type=float, default=60.0, help='seconds between two polls')
+    record_parser.add_argument('--duration', type=float, default=3600.0, help='seconds')
+    record_parser.add_argument('--days', type=int, default=2, help='days to poll, starting today')
+    record_parser.add_argument('--fake', action='store_true', help='poll a fake MRBS server instead of BASE_URL')
+    record_parser.add_argument('--churn', type=float, default=0.5, help='seat changes per second of the fake server')
+
+    args = parser.parse_args()
+    if args.command == 'evaluate':
+        evaluate(args)
+    else:
+        record(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,363 @@
+"""Fake MRBS server with live state, for load tests without touching the library server.
+
+Supports the endpoints the Backend uses: the landing page, day.php, edit_entry_handler.php,
+del_entry.php, report.php, admin.php and the captcha. Every response can be delayed and seats
+are booked and freed randomly in the background to simulate other users.
+
+Usage: python -m benchmarks.fake_mrbs [--port 8080] [--latency 0.3] [--churn 5]
+"""
+import argparse
+import datetime
+import html
+import itertools
+import json
+import random
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from .fixture_server import FixtureServer, BASE_PATH, CAPTCHA_IMAGE, send_body
+
+AREAS = {
+    '20': ('Fachbibliothek Technik', 64),
+    '21': ('Lesesaal Naturwissenschaften', 48),
+    '32': ('DHBW Lernzentrum', 24),
+    '28': ('HsKa Bibliothek', 36),
+}
+DAYTIMES = [('vormittags', 28800), ('nachmittags', 46800), ('abends', 64800)]
+OCCUPIERS = ['K', 'K', 'K', 'D', 'H', 'I', 'G', 'P']
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+
+
+class Entry:
+    __slots__ = ('id', 'occupier', 'user')
+
+    def __init__(self, entry_id: int, occupier: str, user: str = None):
+        self.id = entry_id
+        self.occupier = occupier
+        self.user = user
+
+
+class MRBSState:
+    """Seat grids per (date, area), created lazily with an initial occupancy."""
+
+    def __init__(self, occupancy=0.7, seed=None):
+        self.occupancy = occupancy
+        self.random = random.Random(seed)
+        self.grids = {}
+        self.entries = {}
+        self.sessions = {}
+        self.entry_ids = itertools.count(100000)
+        self.lock = threading.Lock()
+
+    def grid(self, date: datetime.date, area: str) -> list:
+        key = (date, area)
+        if key not in self.grids:
+            seats = AREAS[area][1]
+            rows = []
+            for _ in DAYTIMES:
+                rows.append([self.new_entry(self.random.choice(OCCUPIERS))
+                             if self.random.random() < self.occupancy else None
+                             for _ in range(seats)])
+            self.grids[key] = rows
+        return self.grids[key]
+
+    def new_entry(self, occupier: str, user: str = None) -> Entry:
+        entry = Entry(next(self.entry_ids), occupier, user)
+        self.entries[entry.id] = entry
+        return entry
+
+    def find_entry(self, entry_id: int):
+        for (date, area), rows in self.grids.items():
+            for daytime, row in enumerate(rows):
+                for seat, entry in enumerate(row):
+                    if entry and entry.id == entry_id:
+                        return date, area, daytime, seat
+        return None
+
+    def book(self, user: str, date: datetime.date, area: str, daytime: int, room_id: str) -> str|None:
+        """Returns the broken rule, None on success."""
+        with self.lock:
+            row = self.grid(date, area)[daytime]
+            seat = int(room_id) - room_id_offset(area)
+            if not 0 <= seat < len(row):
+                return 'Unbekannter Platz'
+            if row[seat]:
+                return 'Der Platz ist bereits belegt'
+            for other_area in AREAS:
+                if any(e and e.user == user for e in self.grid(date, other_area)[daytime]):
+                    return 'Du hast zu dieser Zeit bereits einen Platz gebucht'
+            row[seat] = self.new_entry('K', user)
+            return None
+
+    def cancel(self, user: str, entry_id: int) -> bool:
+        with self.lock:
+            entry = self.entries.get(entry_id)
+            if not entry or entry.user != user:
+                return False
+            location = self.find_entry(entry_id)
+            if location:
+                date, area, daytime, seat = location
+                self.grids[(date, area)][daytime][seat] = None
+            del self.entries[entry_id]
+            return True
+
+    def user_entries(self, user: str) -> list:
+        with self.lock:
+            result = []
+            for (date, area), rows in sorted(self.grids.items()):
+                for daytime, row in enumerate(rows):
+                    for seat, entry in enumerate(row):
+                        if entry and entry.user == user:
+                            result.append((date, area, daytime, seat, entry))
+            return result
+
+    def churn(self, changes: int):
+        """Book and free random seats of other users."""
+        with self.lock:
+            if not self.grids:
+                return
+            keys = list(self.grids.keys())
+            for _ in range(changes):
+                rows = self.grids[self.random.choice(keys)]
+                row = self.random.choice(rows)
+                seat = self.random.randrange(len(row))
+                entry = row[seat]
+                if entry is None:
+                    row[seat] = self.new_entry(self.random.choice(OCCUPIERS))
+                elif entry.user is None:
+                    row[seat] = None
+                    self.entries.pop(entry.id, None)
+
+
+def room_id_offset(area: str) -> int:
+    return 1000 + int(area) * 100
+
+
+def render_page(body: str, body_class='day') -> bytes:
+    return f'''<!DOCTYPE html>
+<html lang="de">
+<head><meta charset="utf-8"><title>Sitzplatzreservierung</title></head>
+<body class="{body_class}">
+<div id="contents">
+{body}
+</div>
+</body>
+</html>
+'''.encode()
+
+
+def render_day(state: MRBSState, date: datetime.date, area: str, user: str = None, landing=False) -> bytes:
+    with state.lock:
+        rows = state.grid(date, area)
+        offset = room_id_offset(area)
+        query = f'year={date.year}&amp;month={date.month}&amp;day={date.day}'
+        out = ['<div id="dwm_areas"><h3>Bereiche</h3><ul>']
+        for number, (name, _) in AREAS.items():
+            out.append(f'<li><a href="day.php?{query}&amp;area={number}"><span>{html.escape(name)}</span></a></li>')
+        out.append('</ul></div>')
+        if landing:
+            out.append('<div id="hinweis"><p><strong>Öffnungszeiten</strong> (Testserver)</p>'
+                       '<p>vormittags: 8:00 - 13:00 Uhr<br>nachmittags: 13:00 - 18:00 Uhr<br>'
+                       'abends: 18:00 - 24:00 Uhr</p></div>')
+        out += ['<table class="dwm_main" id="day_main">', '<thead>', '<tr>', '<th class="first_last">Zeitraum:</th>']
+        for seat in range(len(rows[0])):
+            out.append(f'<th data-room="{offset + seat}"><a href="week.php?{query}&amp;room={offset + seat}">\n'
+                       f'<span class="room_name">{seat + 1:03d}</span>\n<span class="capacity">(1)</span></a></th>')
+        out += ['</tr>', '</thead>', '<tbody>']
+        for index, (name, seconds) in enumerate(DAYTIMES):
+            out.append(f'<tr class="{"even_row" if index % 2 == 0 else "odd_row"}">')
+            out.append(f'<td class="row_labels"><div class="celldiv"><a href="day.php?{query}&amp;area={area}'
+                       f'&amp;timetohighlight={seconds}">{name}</a></div></td>')
+            for entry in rows[index]:
+                if entry is None:
+                    out.append('<td class="new"><div class="celldiv"><a href="edit_entry.php"></a></div></td>')
+                elif user and entry.user == user:
+                    out.append(f'<td class="K writable"><div data-id="{entry.id}" class="celldiv">'
+                               f'<a href="view_entry.php?id={entry.id}">{user}</a></div></td>')
+                else:
+                    out.append(f'<td class="{entry.occupier} private"><div data-id="{entry.id}" class="celldiv">'
+                               f'<a href="view_entry.php?id={entry.id}">Privat</a></div></td>')
+            out.append('</tr>')
+        out += ['</tbody>', '</table>']
+    return render_page('\n'.join(out))
+
+
+class FakeMRBSHandler(BaseHTTPRequestHandler):
+    server_version = 'Apache'
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method: str):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            params.update(parse_qs(self.rfile.read(length).decode()))
+        param = lambda name, default=None: params[name][0] if name in params else default
+        endpoint = url.path[len(BASE_PATH):] if url.path.startswith(BASE_PATH) else url.path
+        self.endpoint = endpoint or 'index'
+        self.server.count(self.endpoint)
+        self.server.delay()
+
+        state = self.server.state
+        user = self.server.get_user(self.headers.get('Cookie', ''))
+        if endpoint in ['', 'index.php']:
+            self.respond(render_day(state, datetime.date.today(), '20', user, landing=True))
+        elif endpoint == 'day.php':
+            date = datetime.date(int(param('year')), int(param('month')), int(param('day')))
+            area = param('area')
+            if area not in AREAS:
+                self.send_error(404)
+                return
+            self.respond(render_day(state, date, area, user))
+        elif endpoint == 'edit_entry_handler.php' and method == 'POST':
+            self.edit_entry(user, param)
+        elif endpoint == 'del_entry.php':
+            if user and state.cancel(user, int(param('id'))):
+                self.redirect(BASE_PATH + 'report.php')
+            else:
+                self.respond(render_page('<p>Zugriff verweigert</p>'))
+        elif endpoint == 'report.php':
+            self.report(user or param('creatormatch'))
+        elif endpoint == 'admin.php':
+            if method == 'POST':
+                if param('NewUserName') and param('NewUserPassword'):
+                    self.redirect(BASE_PATH, cookie=self.server.new_session(param('NewUserName')))
+                else:
+                    self.respond(render_page('<p>Unbekannter Benutzer</p>'))
+            elif user:
+                self.respond(render_page(f'<a href="report.php">Buchungsübersicht von<br> {user}</a>', 'admin'))
+            else:
+                self.respond(render_page('<form id="logon" method="post" action="admin.php">'
+                                         '<div id="Captcha"><img src="captcha.php"></div></form>', 'admin'),
+                             cookie=self.server.new_session(None))
+        elif endpoint == 'captcha.php':
+            self.respond(CAPTCHA_IMAGE, content_type='image/gif')
+        else:
+            self.send_error(404)
+
+    def edit_entry(self, user, param):
+        if not user:
+            self.respond(render_page('<p>Zugriff verweigert</p>'))
+            return
+        date = datetime.date(int(param('start_year')), int(param('start_month')), int(param('start_day')))
+        seconds = [str(s) for _, s in DAYTIMES]
+        daytime = seconds.index(param('start_seconds')) if param('start_seconds') in seconds else None
+        area = param('area')
+        if daytime is None or area not in AREAS:
+            broken = 'Ungültige Buchung'
+        elif param('ajax'):
+            # Only checks the rules, the booking is done by the second request
+            with self.server.state.lock:
+                row = self.server.state.grid(date, area)[daytime]
+                seat = int(param('rooms[]')) - room_id_offset(area)
+                broken = 'Der Platz ist bereits belegt' if not 0 <= seat < len(row) or row[seat] else None
+            self.respond(json.dumps({'valid_booking': not broken, 'rules_broken': [broken] if broken else []})
+                         .encode(), content_type='application/json')
+            return
+        else:
+            broken = self.server.state.book(user, date, area, daytime, param('rooms[]'))
+        if broken:
+            self.respond(render_page(f'<p>{html.escape(broken)}</p>'))
+        else:
+            self.redirect(BASE_PATH + f'day.php?area={area}')
+
+    def report(self, user):
+        rows = []
+        for date, area, daytime, seat, entry in self.server.state.user_entries(user) if user else []:
+            start = (f'{DAYTIMES[daytime][0]}, {WEEKDAYS[date.weekday()]} {date.day:02d} '
+                     f'{MONTHS[date.month - 1]} {date.year}')
+            rows.append([f'<a href="view_entry.php?id={entry.id}" data-id="{entry.id}">Ansehen</a>',
+                         AREAS[area][0], f'{seat + 1:03d}',
+                         f'<a href="view_entry.php?id={entry.id}" data-id="{entry.id}">{start}</a>'])
+        self.respond(json.dumps({'aaData': rows}).encode(), content_type='application/json')
+
+    def respond(self, body: bytes, content_type='text/html; charset=utf-8', cookie=None):
+        send_body(self, body, content_type, f'MRBS_SESSID={cookie}' if cookie else None)
+
+    def redirect(self, location: str, cookie=None):
+        self.send_response(302)
+        self.send_header('Location', location)
+        if cookie:
+            self.send_header('Set-Cookie', f'MRBS_SESSID={cookie}; path=/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeMRBSServer(FixtureServer):
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, churn=0.0, occupancy=0.7, seed=None,
+                 compress=True, etags=False):
+        super().__init__(address, FakeMRBSHandler, compress=compress, etags=etags)
+        self.state = MRBSState(occupancy=occupancy, seed=seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.churn = churn
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def new_session(self, user: str|None) -> str:
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.state.sessions[token] = user
+        return token
+
+    def get_user(self, cookie_header: str) -> str|None:
+        for cookie in cookie_header.split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'MRBS_SESSID':
+                with self.lock:
+                    return self.state.sessions.get(value)
+        return None
+
+    def start(self):
+        super().start()
+        if self.churn:
+            threading.Thread(target=self.run_churn, daemon=True).start()
+        return self
+
+    def run_churn(self):
+        """Apply about `churn` seat changes per second."""
+        while True:
+            time.sleep(1)
+            self.state.churn(int(self.churn) + (random.random() < self.churn % 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake MRBS server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency up to this many seconds')
+    parser.add_argument('--churn', type=float, default=0.0, help='seat changes per second by other users')
+    parser.add_argument('--occupancy', type=float, default=0.7)
+    parser.add_argument('--no-compress', action='store_true', help='never compress responses')
+    parser.add_argument('--etags', action='store_true', help='send ETags and answer If-None-Match with 304')
+    args = parser.parse_args()
+
+    server = FakeMRBSServer((args.host, args.port), latency=args.latency, jitter=args.jitter, churn=args.churn,
+                            occupancy=args.occupancy, compress=not args.no_compress, etags=args.etags)
+    print(f'Serving fake MRBS at {server.base_url}')
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Local stand-in for the library server, answering with the recorded pages in fixtures/."""
+import gzip
+import hashlib
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+BASE_PATH = '/sitzplatzreservierung/'
+
+# Smallest valid GIF, good enough as captcha image
+CAPTCHA_IMAGE = b'GIF89a\x01\x00\x01\x00\x00\x00\x00;'
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def send_body(handler: BaseHTTPRequestHandler, body: bytes, content_type: str, cookie: str = None):
+    """Send a page like the library server: gzip compressed if accepted and, if enabled, with an ETag."""
+    etag = f'"{hashlib.md5(body).hexdigest()}"' if handler.server.etags else None
+    if etag and handler.headers.get('If-None-Match') == etag:
+        handler.send_response(304)
+        handler.send_header('ETag', etag)
+        handler.end_headers()
+        return
+    compress = handler.server.compress and 'gzip' in handler.headers.get('Accept-Encoding', '')
+    if compress:
+        body = gzip.compress(body, compresslevel=6)
+    handler.send_response(200)
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(len(body)))
+    if compress:
+        handler.send_header('Content-Encoding', 'gzip')
+    if etag:
+        handler.send_header('ETag', etag)
+    if cookie:
+        handler.send_header('Set-Cookie', f'{cookie}; path=/')
+    handler.end_headers()
+    handler.wfile.write(body)
+    handler.server.count_bytes(handler.endpoint, len(body))
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    server_version = 'Apache'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        endpoint = url.path[len(BASE_PATH):] if url.path.startswith(BASE_PATH) else url.path
+        self.endpoint = endpoint or 'index'
+        self.server.count(self.endpoint)
+
+        if endpoint in ['', 'index.php']:
+            self.respond(read_fixture('landing.html'))
+        elif endpoint == 'day.php':
+            area = ''.join(params.get('area', []))
+            name = f'day-{area}.html'
+            if not os.path.exists(os.path.join(FIXTURES_DIR, name)):
+                name = 'landing.html'
+            self.respond(read_fixture(name))
+        elif endpoint == 'report.php':
+            self.respond(read_fixture('report.json'), content_type='application/json')
+        elif endpoint == 'admin.php':
+            logged_in = 'MRBS_SESSID=logged-in' in self.headers.get('Cookie', '')
+            self.respond(read_fixture('admin-logged-in.html' if logged_in else 'admin.html'),
+                         cookie='MRBS_SESSID=anonymous')
+        elif endpoint == 'captcha.php':
+            self.respond(CAPTCHA_IMAGE, content_type='image/gif')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        endpoint = url.path[len(BASE_PATH):]
+        self.endpoint = endpoint
+        self.server.count(endpoint)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if endpoint == 'admin.php':
+            self.send_response(302)
+            self.send_header('Location', BASE_PATH)
+            self.send_header('Set-Cookie', 'MRBS_SESSID=logged-in; path=/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def respond(self, body: bytes, content_type='text/html; charset=utf-8', cookie=None):
+        send_body(self, body, content_type, cookie)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), handler=FixtureHandler, compress=True, etags=False):
+        super().__init__(address, handler)
+        self.compress = compress
+        self.etags = etags
+        self.requests = Counter()
+        self.bytes_sent = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def count_bytes(self, endpoint: str, size: int):
+        with self.lock:
+            self.bytes_sent[endpoint] += size
+
+    def reset_bytes(self) -> dict:
+        with self.lock:
+            sent = dict(self.bytes_sent)
+            self.bytes_sent.clear()
+        return sent
+
+    def reset_counts(self) -> dict:
+        with self.lock:
+            counts = dict(self.requests)
+            self.requests.clear()
+        return counts
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}{BASE_PATH}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,294 @@
+"""Simulated users driving the real bot handlers against the fake MRBS server.
+
+Usage: python -m benchmarks.load [--users 50] [--duration 60] [--latency 0.3] [--churn 5]
+
+Like the real bot, updates are handled by a single dispatcher thread unless --dispatcher-threads
+is raised. With --cache-backend redis (default), the database given by --redis-db is flushed!
+"""
+import argparse
+import datetime
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from .fake_mrbs import FakeMRBSServer
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'telegram-bot.py')
+
+
+def load_bot_module():
+    spec = importlib.util.spec_from_file_location('telegram_bot', BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeBot:
+    """Stands in for telegram.Bot, records the sent messages instead of calling Telegram."""
+    defaults = None
+    username = 'KITSitzplatzBot'
+
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.inbox = defaultdict(list)
+
+    def record(self, method: str, chat_id, **content):
+        with self.lock:
+            self.calls[method] += 1
+            if content:
+                self.inbox[chat_id].append(content)
+
+    def make_message(self, chat_id, text=None):
+        from telegram import Chat, Message
+        return Message(next(self.message_ids), datetime.datetime.now(), Chat(chat_id, Chat.PRIVATE), text=text, bot=self)
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        keyboard = [button if isinstance(button, str) else button.text
+                    for row in (reply_markup.keyboard if reply_markup else []) for button in row]
+        self.record('send_message', chat_id, text=text, keyboard=keyboard)
+        return self.make_message(chat_id, text)
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self.record('send_photo', chat_id, text=caption, keyboard=[])
+        return self.make_message(chat_id)
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        self.record('send_chat_action', chat_id)
+        return True
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self.record('delete_message', chat_id)
+        return True
+
+    def pin_chat_message(self, chat_id, message_id, **kwargs):
+        self.record('pin_chat_message', chat_id)
+        return True
+
+    def unpin_all_chat_messages(self, chat_id, **kwargs):
+        self.record('unpin_all_chat_messages', chat_id)
+        return True
+
+    def replies(self, chat_id) -> list:
+        with self.lock:
+            replies = self.inbox.pop(chat_id, [])
+        return replies
+
+
+class LoadTest:
+    def __init__(self, bot_module, server: FakeMRBSServer, dispatcher_threads: int, think_time: float):
+        from telegram.ext import Dispatcher
+
+        self.bot_module = bot_module
+        self.server = server
+        self.think_time = think_time
+        self.bot = FakeBot()
+        self.dispatcher = Dispatcher(self.bot, queue.Queue(), workers=1)
+        self.dispatcher.add_error_handler(self.on_error)
+        bot_module.add_handlers(self.dispatcher)
+        self.updates = queue.Queue()
+        self.update_ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.workers = [threading.Thread(target=self.dispatch, daemon=True) for _ in range(dispatcher_threads)]
+        for worker in self.workers:
+            worker.start()
+
+    def on_error(self, update, context):
+        with self.lock:
+            self.errors[type(context.error).__name__] += 1
+
+    def dispatch(self):
+        while True:
+            update, done = self.updates.get()
+            try:
+                self.dispatcher.process_update(update)
+            finally:
+                done.set()
+
+    def send(self, user_id: int, text: str, step: str) -> list:
+        """Send a message as a user and wait until the bot handled it."""
+        from telegram import Chat, Message, MessageEntity, Update, User
+
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))] if text.startswith('/') else []
+        message = Message(next(self.update_ids), datetime.datetime.now(), Chat(user_id, Chat.PRIVATE),
+                          from_user=User(user_id, f'User {user_id}', False), text=text, entities=entities,
+                          bot=self.bot)
+        update = Update(message.message_id, message=message)
+        done = threading.Event()
+        start = time.perf_counter()
+        self.updates.put((update, done))
+        done.wait()
+        with self.lock:
+            self.latencies[step].append(time.perf_counter() - start)
+        return self.bot.replies(user_id)
+
+    def think(self):
+        if self.think_time:
+            time.sleep(random.expovariate(1 / self.think_time))
+
+    def run_user(self, user_id: int):
+        self.login(user_id)
+        while not self.stopped.is_set():
+            flow = random.choices([self.browse, self.drill_down, self.book_and_cancel], weights=[7, 2, 1])[0]
+            flow(user_id)
+            self.think()
+
+    def login(self, user_id: int):
+        self.send(user_id, 'Login', 'login')
+        self.send(user_id, str(user_id), 'login_username')
+        self.send(user_id, 'secret', 'login_password')
+
+    def overview(self, user_id: int) -> str:
+        day = random.choice(self.bot_module.FREE_SEAT_MARKUP)
+        self.send(user_id, day, 'day_selected')
+        daytime = random.choice(self.bot_module.get_daytime_markup())
+        replies = self.send(user_id, daytime, 'time_selected')
+        return '\n'.join(reply['text'] or '' for reply in replies)
+
+    def browse(self, user_id: int):
+        self.overview(user_id)
+
+    def drill_down(self, user_id: int):
+        commands = re.findall(r'/B\d_\d_\d+\b(?!_)', self.overview(user_id))
+        if commands:
+            self.think()
+            self.send(user_id, random.choice(commands), 'seat_keyboard')
+
+    def book_and_cancel(self, user_id: int):
+        text = self.overview(user_id)
+        seats = re.findall(r'/B\d_\d_\d+_[A-Z0-9]+_[A-Z0-9_]+', text)
+        if not seats:
+            areas = re.findall(r'/B\d_\d_\d+\b(?!_)', text)
+            if not areas:
+                return
+            replies = self.send(user_id, random.choice(areas), 'seat_keyboard')
+            seats = [button for reply in replies for button in reply['keyboard'] if button.startswith('/B')]
+            if not seats:
+                return
+        self.think()
+        self.send(user_id, random.choice(seats), 'book')
+        self.think()
+        replies = self.send(user_id, 'Reservierungen', 'reservations')
+        entries = re.findall(r'/C\d+', '\n'.join(reply['text'] or '' for reply in replies))
+        if entries:
+            self.think()
+            self.send(user_id, random.choice(entries), 'cancel')
+
+    def run(self, users: int, duration: float) -> dict:
+        self.server.reset_counts()
+        self.server.reset_bytes()
+        threads = [threading.Thread(target=self.run_user, args=(100000 + i,), daemon=True) for i in range(users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        self.stopped.wait(duration)
+        self.stopped.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return self.report(users, elapsed)
+
+    def report(self, users: int, elapsed: float) -> dict:
+        all_latencies = sorted(itertools.chain.from_iterable(self.latencies.values()))
+        updates = len(all_latencies)
+        upstream = self.server.reset_counts()
+        upstream_bytes = self.server.reset_bytes()
+        return {
+            'users': users,
+            'duration_s': round(elapsed, 1),
+            'updates': updates,
+            'throughput_per_s': round(updates / elapsed, 2),
+            'latency': summarize(all_latencies),
+            'latency_per_step': {step: summarize(sorted(values)) for step, values in self.latencies.items()},
+            'upstream_requests': upstream,
+            'upstream_per_update': round(sum(upstream.values()) / updates, 2) if updates else None,
+            'upstream_kib': {endpoint: round(size / 1024, 1) for endpoint, size in upstream_bytes.items()},
+            'parse_skips': {'.'.join(labels): value for labels, value in get_parse_skips().items()},
+            'telegram_calls': dict(self.bot.calls),
+            'errors': dict(self.errors),
+        }
+
+
+def get_parse_skips() -> dict:
+    from reservations.metrics import PARSE_SKIPS
+    return {tuple(sample.labels.values()): sample.value for metric in PARSE_SKIPS.collect()
+            for sample in metric.samples if sample.name.endswith('_total')}
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {}
+    percentile = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {
+        'count': len(values),
+        'mean_ms': round(statistics.mean(values) * 1000, 1),
+        'p50_ms': round(percentile(0.5) * 1000, 1),
+        'p90_ms': round(percentile(0.9) * 1000, 1),
+        'p99_ms': round(percentile(0.99) * 1000, 1),
+        'max_ms': round(values[-1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the bot handlers against a fake MRBS server')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean seconds between two user actions')
+    parser.add_argument('--dispatcher-threads', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds added to every upstream response')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--churn', type=float, default=2.0, help='seat changes per second by other users')
+    parser.add_argument('--no-compress', action='store_true', help='the fake server never compresses responses')
+    parser.add_argument('--etags', action='store_true', help='the fake server answers conditional requests')
+    parser.add_argument('--redis-db', type=int, default=int(os.environ.get('BENCH_REDIS_DB', 15)))
+    parser.add_argument('--cache-backend', choices=['redis', 'memory', 'sqlite'], default='redis')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    args = parser.parse_args()
+
+    server = FakeMRBSServer(latency=args.latency, jitter=args.jitter, churn=args.churn,
+                            compress=not args.no_compress, etags=args.etags).start()
+    # Has to be set before the bot module and reservations are imported
+    os.environ.update({
+        'REDIS_DB': str(args.redis_db),
+        'CACHE_BACKEND': args.cache_backend,
+        'CACHE_PATH': os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'),
+        'BASE_URL': server.base_url,
+        'CAPTCHA_ENABLED': 'false',
+    })
+    os.environ.pop('PROXY', None)
+    os.environ.pop('PROXIES', None)
+    os.environ.pop('MAINTENANCE_NOTICE', None)
+    from reservations import cache
+    cache.flushdb()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bot_module = load_bot_module()
+    logging.getLogger().setLevel(logging.WARNING)
+    results = LoadTest(bot_module, server, args.dispatcher_threads, args.think_time).run(args.users, args.duration)
+    server.shutdown()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""Offline benchmarks against the recorded fixtures.
+
+Usage: python -m benchmarks.run [--output results.json]
+
+Needs a running redis unless --cache-backend is memory or sqlite, the database given by --redis-db is flushed!
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from .fixture_server import FixtureServer, read_fixture
+
+
+def measure(fn, repeat: int) -> dict:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return {
+        'median_ms': round(statistics.median(durations), 3),
+        'min_ms': round(durations[0], 3),
+        'max_ms': round(durations[-1], 3),
+    }
+
+
+def get_commit() -> str|None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_parsing(repeat: int) -> dict:
+    from reservations.backend import parse_areas, parse_daytimes, parse_room_entries, parse_reservations, \
+        parse_captcha_url
+
+    landing = read_fixture('landing.html').decode()
+    day = read_fixture('day-20.html').decode()
+    report = read_fixture('report.json').decode()
+    admin = read_fixture('admin.html').decode()
+    pages = {
+        'landing': (landing, lambda: (parse_areas(landing), parse_daytimes(landing))),
+        'day.php': (day, lambda: parse_room_entries(day, '20')),
+        'report.php': (report, lambda: parse_reservations(report)),
+        'admin.php': (admin, lambda: parse_captcha_url(admin)),
+    }
+    results = {}
+    for page, (text, fn) in pages.items():
+        results[page] = {'bytes': len(text.encode()), **measure(fn, repeat)}
+    return results
+
+
+def bench_startup(server: FixtureServer, repeat: int) -> dict:
+    from reservations import cache
+    from reservations.backend import Backend, METADATA_SNAPSHOT
+
+    import_ms = []
+    for _ in range(min(repeat, 5)):
+        output = subprocess.check_output([sys.executable, '-c',
+                                          'import time; start = time.perf_counter(); import reservations.backend; '
+                                          'print(time.perf_counter() - start)'])
+        import_ms.append(float(output) * 1000)
+    results = {'import_backend_ms': round(statistics.median(import_ms), 3)}
+
+    def first_access(clear_redis: bool, remove_snapshot: bool):
+        if clear_redis:
+            cache.delete('areas', 'daytimes')
+        if remove_snapshot and os.path.exists(METADATA_SNAPSHOT):
+            os.remove(METADATA_SNAPSHOT)
+        return lambda: Backend(server.base_url).areas
+
+    for name, clear_redis, remove_snapshot in [('network', True, True), ('snapshot', True, False),
+                                               ('redis', False, False)]:
+        durations = []
+        server.reset_counts()
+        for _ in range(repeat):
+            fn = first_access(clear_redis, remove_snapshot)
+            start = time.perf_counter()
+            fn()
+            durations.append((time.perf_counter() - start) * 1000)
+        # The snapshot triggers a refresh in the background, give it a moment to be counted
+        time.sleep(0.2)
+        results[f'metadata_from_{name}'] = {
+            'median_ms': round(statistics.median(durations), 3),
+            'upstream_requests_per_start': {k: v / repeat for k, v in server.reset_counts().items()},
+        }
+    return results
+
+
+def measure_memory(fn) -> tuple:
+    """Run fn and return its result, the bytes and blocks still allocated afterwards and the peak in bytes."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return result, sum(s.size_diff for s in stats), sum(s.count_diff for s in stats), peak
+
+
+def bench_search(server: FixtureServer, repeat: int) -> dict:
+    from reservations import cache
+    from reservations.backend import Backend, get_room_entries_version_key
+
+    server.reset_counts()
+    b = Backend(server.base_url)
+    results = {'startup': {'upstream_requests': server.reset_counts()}}
+    date = datetime.datetime.today() + datetime.timedelta(days=1)
+
+    def search():
+        return b.search_bookings(start_day=date)
+
+    def cold():
+        cache.flushdb()
+        b.room_entries_l1.clear()
+        search()
+
+    def warm_redis():
+        b.room_entries_l1.clear()
+        search()
+
+    def seat_index_warm_redis():
+        # What the overview needs: free and total seats of every area
+        b.room_entries_l1.clear()
+        for area in b.areas:
+            b.get_seat_index(date, area)
+
+    def revalidate():
+        # Grids expired but unchanged upstream, they are fetched but not parsed again
+        cache.delete(*[get_room_entries_version_key(date, area) for area in b.areas])
+        b.room_entries_l1.clear()
+        search()
+
+    def seat_summary():
+        b.get_seat_summary(date, 0)
+
+    for name, fn in [('cold', cold), ('revalidate', revalidate), ('warm_redis', warm_redis), ('warm_l1', search),
+                     ('seat_index_warm_redis', seat_index_warm_redis), ('seat_summary', seat_summary)]:
+        search()  # make sure the caches are in the expected state
+        server.reset_counts()
+        results[name] = measure(fn, repeat)
+        requests = server.reset_counts()
+        results[name]['upstream_requests_per_query'] = {k: v / repeat for k, v in requests.items()}
+
+    bookings, allocated, blocks, _ = measure_memory(search)
+    results['memory'] = {
+        'bookings': len(bookings),
+        'bytes_per_booking': round(allocated / len(bookings), 1) if bookings else None,
+        'blocks_per_booking': round(blocks / len(bookings), 2) if bookings else None,
+    }
+
+    # Full sweep over all areas of four days, with the grids decoded from the cache like after the
+    # in-process cache expired. Retained memory covers the bookings and the grids kept in process.
+    def sweep():
+        b.room_entries_l1.clear()
+        return b.search_bookings(start_day=date, day_count=4)
+    sweep()
+    bookings, allocated, blocks, peak = measure_memory(sweep)
+    results['memory_sweep'] = {
+        'bookings': len(bookings),
+        'retained_kib': round(allocated / 1024, 1),
+        'peak_kib': round(peak / 1024, 1),
+        'blocks': blocks,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the offline benchmarks')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--redis-db', type=int, default=int(os.environ.get('BENCH_REDIS_DB', 15)))
+    parser.add_argument('--cache-backend', choices=['redis', 'memory', 'sqlite'], default='redis')
+    args = parser.parse_args()
+
+    # Has to happen before reservations is imported, the cache is set up on import
+    snapshot_dir = tempfile.mkdtemp()
+    os.environ.update({
+        'REDIS_DB': str(args.redis_db),
+        'CACHE_BACKEND': args.cache_backend,
+        'CACHE_PATH': os.path.join(snapshot_dir, 'cache.sqlite3'),
+        'METADATA_SNAPSHOT': os.path.join(snapshot_dir, 'metadata-snapshot.json'),
+    })
+    os.environ.pop('PROXY', None)
+    os.environ.pop('PROXIES', None)
+
+    server = FixtureServer().start()
+    try:
+        # The backend prints cache reloads, keep them out of the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = {
+                'commit': get_commit(),
+                'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'cache_backend': args.cache_backend,
+                'parse': bench_parsing(args.repeat),
+                'startup': bench_startup(server, args.repeat),
+                'search_bookings': bench_search(server, args.repeat),
+            }
+    finally:
+        server.shutdown()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
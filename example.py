@@ -1,21 +1,20 @@
 # /usr/bin/python3
 import datetime
 
-from reservations.backend import Backend, Daytime, State
-from reservations.query import group_bookings
+from reservations.backend import Backend
+from reservations.query import aggregate_bookings
 
 base_url = 'https://raumbuchung.bibliothek.kit.edu/sitzplatzreservierung/'
 
 b = Backend(base_url)
 
-daytimes = (Daytime.MORNING, Daytime.AFTERNOON)
-bookings = b.search_bookings(start_day=datetime.datetime.today() + datetime.timedelta(days=2),
-                                   state=State.FREE,
-                                   daytimes=daytimes)
-grouped = group_bookings(bookings, daytimes)
+daytimes = [daytime['index'] for daytime in b.daytimes[:2]]
+bookings = b.iter_bookings(start_day=datetime.datetime.today() + datetime.timedelta(days=2),
+                           daytimes=daytimes)
+aggregated = aggregate_bookings(bookings, b.areas, daytimes, keep_seats=False)
 
-for daytime, rooms in grouped.items():
-    print(daytime)
-    for room, seats in rooms.items():
-        print(f'{room}: {len(seats)}')
+for daytime, rooms in aggregated.items():
+    print(b.daytimes[daytime]['name'])
+    for room, counts in rooms.items():
+        print(f"{room}: {counts['free']} von {counts['total']} frei")
     print()
@@ -1,7 +1,3 @@
-import os
-import redis as redis_cache
+from .cache import create_cache
 
-redis = redis_cache.Redis(
-    host=os.environ.get('REDIS_HOST', 'localhost'),
-    port=int(os.environ.get('REDIS_PORT', 6379)),
-    db=int(os.environ.get('REDIS_DB', 0)))
+cache = create_cache()
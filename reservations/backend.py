@@ -1,97 +1,176 @@
+import concurrent.futures
+import contextvars
 import datetime
+import hashlib
 import json
 import os
 import pickle
 import random
 import re
 import logging
+import sys
+import tempfile
+import threading
+import time
 import traceback
 import urllib
-from enum import IntEnum
 from io import BytesIO
 from urllib.parse import urljoin
-from markdownify import markdownify as md
 
-import bs4
 import requests
+import urllib3
 from dateutil import rrule
 from requests.cookies import RequestsCookieJar
 
-from . import redis
-
-
-class State(IntEnum):
-    FREE = 1
-    OCCUPIED = 2
-    MINE = 3
-    UNKNOWN = 4
+from . import cache
+from .records import State, Seat, Grid, Booking, SeatIndex, SummaryEntry
+from .metrics import UPSTREAM_REQUESTS, UPSTREAM_LATENCY, UPSTREAM_BYTES, PARSE_DURATION, PARSE_SKIPS, \
+    EXPIRY_TIME, LOGIN_RENEWALS, BOOKING_DURATION, UPSTREAM_RETRIES_TOTAL, UPSTREAM_HEDGES, count_cache, get_endpoint
+from .tracing import span, traced, current_span
+from .context import get_user_cache
+from .expiry import create_expiry_policy, record_refresh
+from .proxies import ProxyPool, get_proxy_urls
+from .upstream import UpstreamUnavailable, CircuitBreaker, LatencyTracker, get_timeout, is_idempotent, \
+    UPSTREAM_RETRIES, UPSTREAM_BACKOFF, RETRY_STATUS, PROBE
+
+
+ROOM_ENTRIES_L1_EXPIRY = int(os.environ.get('ROOM_ENTRIES_L1_EXPIRY', 5))
+METADATA_SNAPSHOT = os.environ.get('METADATA_SNAPSHOT', 'metadata-snapshot.json')
+METADATA_TIMEOUT = int(os.environ.get('METADATA_TIMEOUT', 30))
+# How long grids are kept after they expired, to revalidate them instead of loading them again
+ROOM_ENTRIES_STALE_EXPIRY = int(os.environ.get('ROOM_ENTRIES_STALE_EXPIRY', 24 * 3600))
+# Everything urllib3 can decompress, e.g. gzip, deflate and br if brotli is installed
+ACCEPT_ENCODING = urllib3.util.request.ACCEPT_ENCODING
+# Free seats listed per area in the summary, the overview shows them if there are no more
+SUMMARY_SEATS = 3
+# Bookings of a batch submitted at the same time
+BOOKING_CONCURRENCY = int(os.environ.get('BOOKING_CONCURRENCY', 4))
+# Load the captcha in the background once a login is to be expected, defaults to CAPTCHA_ENABLED
+CAPTCHA_PREFETCH = os.environ.get('CAPTCHA_PREFETCH', os.environ.get('CAPTCHA_ENABLED', '')).lower() == 'true'
+# Seconds a prefetched captcha and its session are handed out, the library server keeps sessions longer
+CAPTCHA_PREFETCH_EXPIRY = int(os.environ.get('CAPTCHA_PREFETCH_EXPIRY', 5 * 60))
+# Connections to the library server kept open per proxy
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 32))
 
 
 class Backend:
     def __init__(self, base_url: str):
         self.base_url = base_url
-        self.proxy = os.environ.get('PROXY')
-
-        self.daytimes = self.get_daytimes()
-        self.areas = self.get_areas()
+        proxy_urls = get_proxy_urls()
+        self.proxies = ProxyPool(proxy_urls, self.probe_proxy) if proxy_urls else None
+        self.circuit = CircuitBreaker()
+        self.latencies = LatencyTracker()
+        self.hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+        # Shared by all requests, so they reuse open connections. Cookies stay in a session per request.
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=len(proxy_urls) + 1, pool_maxsize=UPSTREAM_POOL_SIZE)
+        # user_id -> (monotonic expiry, future of (photo, cookies))
+        self.captchas = {}
+        self.captcha_lock = threading.Lock()
+        self.prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefetch')
+        # In-process cache in front of redis: key -> (monotonic expiry, times), changed under l1_lock
+        self.room_entries_l1 = {}
+        self.l1_lock = threading.Lock()
+        self.expiry_policy = create_expiry_policy(cache)
+
+        # Areas and daytimes are loaded on first use, so creating a Backend needs no network access
+        self._areas = None
+        self._daytimes = None
+        self.metadata_lock = threading.Lock()
+        # Future of the load in progress, the other callers wait for it instead of loading as well
+        self.metadata_loading = None
+
+    @property
+    def areas(self) -> dict:
+        if self._areas is None:
+            self.load_metadata()
+        return self._areas
+
+    @property
+    def daytimes(self) -> list:
+        if self._daytimes is None:
+            self.load_metadata()
+        return self._daytimes
 
     def get_areas(self) -> dict:
-        redis_key = f'areas'
-        areas_json = redis.get(redis_key)
-        areas = json.loads(areas_json) if areas_json else None
-        if not areas:
-            print('Cache: reloading areas')
-            r = self.get_request('/sitzplatzreservierung/')
-            b = bs4.BeautifulSoup(r.text, 'lxml')
-
-            area_div = b.find('div', id='dwm_areas')
-            areas = {}
-            for li in area_div.find_all('li'):
-                name = li.text.strip()
-                url = urllib.parse.urlparse(li.a.get('href'))
-                params = urllib.parse.parse_qs(url.query)
-                number = ''.join(params['area'])
-                areas[number] = name
-            redis.set(redis_key, json.dumps(areas), ex=24 * 3600)
-        return areas
+        return self.areas
 
     def get_daytimes(self) -> list:
-        redis_key = f'daytimes'
-        daytimes_json = redis.get(redis_key)
-        daytimes = json.loads(daytimes_json) if daytimes_json else None
-        if not daytimes:
-            print('Cache: reloading daytimes')
-            r = self.get_request('/sitzplatzreservierung/')
-            b = bs4.BeautifulSoup(r.text, 'lxml')
-
-            table = b.find(id="day_main")
-
-            rows = [r for r in table.tbody.children
-                    if type(r) == bs4.element.Tag
-                    and ('even_row' in r.attrs["class"] or 'odd_row' in r.attrs["class"])]
-            daytimes = []
-            index = 0
-            for row in rows:
-                link = row.div.a
-                href = link.attrs['href']
-                seconds_match = re.search('timetohighlight=(.*)$', href)
-                seconds = seconds_match.group(1)
-                name = link.text
-                daytimes.append({
-                    'name': name,
-                    'seconds': seconds,
-                    'index': index
-                })
-                index += 1
-            redis.set(redis_key, json.dumps(daytimes), ex=24 * 3600)
-        return daytimes
+        return self.daytimes
+
+    def load_metadata(self):
+        """Load areas and daytimes from redis or the snapshot file, only if both miss from the library server.
+
+        The lock is only held to check and publish them. Callers arriving while another one loads wait up
+        to METADATA_TIMEOUT seconds for its result.
+        """
+        with self.metadata_lock:
+            if self._areas is not None and self._daytimes is not None:
+                return
+            loading = self.metadata_loading
+            leader = loading is None
+            if leader:
+                loading = self.metadata_loading = concurrent.futures.Future()
+        if not leader:
+            loading.result(timeout=METADATA_TIMEOUT)
+            return
+        try:
+            areas_json, daytimes_json = cache.mget(['areas', 'daytimes'])
+            areas = json.loads(areas_json) if areas_json else None
+            daytimes = json.loads(daytimes_json) if daytimes_json else None
+            count_cache('metadata', 'hit' if areas and daytimes else 'miss')
+            if not areas or not daytimes:
+                snapshot = read_metadata_snapshot()
+                if snapshot:
+                    print('Cache: loaded areas and daytimes from snapshot')
+                    areas, daytimes = snapshot['areas'], snapshot['daytimes']
+                    # Serve the snapshot right away and refresh it in the background
+                    threading.Thread(target=self.refresh_metadata, name='reload-metadata', daemon=True).start()
+                else:
+                    areas, daytimes = self.reload_metadata()
+        except Exception as e:
+            with self.metadata_lock:
+                self.metadata_loading = None
+            loading.set_exception(e)
+            raise
+        with self.metadata_lock:
+            if self._areas is None or self._daytimes is None:
+                self._areas, self._daytimes = areas, daytimes
+            self.metadata_loading = None
+        loading.set_result(None)
+
+    def reload_metadata(self) -> tuple[dict, list]:
+        print('Cache: reloading areas and daytimes')
+        try:
+            r = self.get_request('/sitzplatzreservierung/', timeout=METADATA_TIMEOUT)
+            areas = parse_areas(r.text)
+            daytimes = parse_daytimes(r.text)
+        except Exception as e:
+            logging.error(f'Loading areas and daytimes failed: {e}')
+            raise
+        cache.set('areas', json.dumps(areas), ex=24 * 3600)
+        cache.set('daytimes', json.dumps(daytimes), ex=24 * 3600)
+        write_metadata_snapshot(areas, daytimes)
+        with self.metadata_lock:
+            self._areas, self._daytimes = areas, daytimes
+        return areas, daytimes
+
+    def refresh_metadata(self):
+        """reload_metadata for background threads, the snapshot keeps being served if it fails"""
+        try:
+            self.reload_metadata()
+        except Exception:
+            # Logged by reload_metadata already
+            pass
 
     def get_times(self) -> str:
         redis_key = f'times'
-        times_data = redis.get(redis_key)
+        times_data = cache.get(redis_key)
         times = times_data.decode('UTF-8') if times_data else None
         if not times:
             print('Cache: reloading times')
+            # Only needed here, so the import does not slow down startup
+            import bs4
+            from markdownify import markdownify as md
             r = self.get_request('/sitzplatzreservierung/')
             b = bs4.BeautifulSoup(r.text, 'lxml')
 
@@ -120,7 +199,7 @@ class Backend:
                 text = text[:-1]
                 times = text
 
-                redis.set(redis_key, times.encode('UTF-8'), ex=24 * 3600)
+                cache.set(redis_key, times.encode('UTF-8'), ex=24 * 3600)
             except Exception as e:
                 with open('last-error-times.log', 'w') as f:
                     f.write(str(e) + '\n\n')
@@ -134,15 +213,22 @@ class Backend:
             -> RequestsCookieJar|None:
         cookies_key = f'login-cookies:{user_id}'
         if not cookies:
-            cookies_pickle = redis.get(cookies_key)
+            cookies_pickle = get_user_cache().get(cookies_key)
             cookies = pickle.loads(cookies_pickle) if cookies_pickle else None
+            count_cache('login_cookies', 'hit' if cookies else 'miss')
         if cookies and not login_required:
             return cookies
         else:
             if not user or not password:
+                if self.circuit.is_open:
+                    # The session cannot be checked while the library server is down, keep it as it is
+                    return cookies
                 res = self.get_request('admin.php', cookies=cookies)
                 if 'Buchungsübersicht von' in res.text:
                     return res.cookies
+                if CAPTCHA_PREFETCH and login_required and not captcha:
+                    # The session has to be renewed with a captcha, the page just loaded shows one
+                    self.prefetch_captcha(user_id, login_page=res)
 
             # Renew cookies using creds
             if not user or not password:
@@ -167,6 +253,7 @@ class Backend:
                                               cookies=cookies,
                                               allow_redirects=False)
                 if login_res.status_code == 200:
+                    LOGIN_RENEWALS.labels('failed').inc()
                     print(f'Login failed: {user}')
                     print(login_res.text)
                     data['NewUserPassword'] = '***REDACTED***'
@@ -181,146 +268,268 @@ class Backend:
                             old_user = user
                             user = user_match.group(1)
                             print(f'Logged in {old_user} as {user}')
+                            LOGIN_RENEWALS.labels('success').inc()
                             creds_json = {
                                 'user': user,
                                 'password': password
                             }
                             set_user_creds(user_id, creds_json)
-                            redis.set(cookies_key, pickle.dumps(login_res.cookies))
+                            get_user_cache().set(cookies_key, pickle.dumps(login_res.cookies))
                             return login_res.cookies
             return None
 
-    def get_captcha(self) -> (BytesIO, RequestsCookieJar):
-        res = self.get_request('admin.php')
-        b = bs4.BeautifulSoup(res.text, 'lxml')
-        captcha_div = b.find('div', attrs={'id': 'Captcha'})
-        if not captcha_div:
-            return None, None
-        captcha_img = captcha_div.img
-        if not captcha_img or 'src' not in captcha_img.attrs:
+    def get_captcha(self, user_id=None) -> (BytesIO, RequestsCookieJar):
+        """A captcha and the cookies of its session, prefetched for the user if possible"""
+        with self.captcha_lock:
+            prefetched = self.captchas.pop(user_id, None) if user_id is not None else None
+        if prefetched and prefetched[0] > time.monotonic():
+            try:
+                photo, cookies = prefetched[1].result()
+                if photo:
+                    count_cache('captcha', 'hit')
+                    return photo, cookies
+            except Exception as e:
+                logging.warning(f'Prefetching the captcha failed: {e}')
+        count_cache('captcha', 'stale' if prefetched else 'miss')
+        return self.load_captcha()
+
+    def prefetch_captcha(self, user_id, login_page: requests.Response = None):
+        """Load a captcha for the user in the background, for the next get_captcha.
+
+        With the login page at hand, e.g. from checking an expired session, only the image is loaded.
+        """
+        now = time.monotonic()
+        with self.captcha_lock:
+            prefetched = self.captchas.get(user_id)
+            if prefetched and prefetched[0] > now:
+                return
+            for key in [k for k, (expires, _) in self.captchas.items() if expires <= now]:
+                del self.captchas[key]
+            future = self.prefetch_executor.submit(contextvars.copy_context().run, self.load_captcha, login_page)
+            self.captchas[user_id] = (now + CAPTCHA_PREFETCH_EXPIRY, future)
+
+    def load_captcha(self, login_page: requests.Response = None) -> (BytesIO, RequestsCookieJar):
+        res = login_page or self.get_request('admin.php')
+        url = parse_captcha_url(res.text)
+        if not url:
             return None, None
-        url = captcha_img.attrs['src']
         url = self.get_absolute_url(url)
         res = self.get_request(url, cookies=res.cookies)
         # photo = BytesIO(res.content)
         # photo.seek(0)
         return res.content, res.cookies
 
-    def get_room_entries(self, date: datetime.datetime, area, cookies: RequestsCookieJar = None) -> tuple[dict, bool]:
+    @traced('get_room_entries')
+    def get_room_entries(self, date: datetime.datetime, area, cookies: RequestsCookieJar = None) -> tuple[Grid, bool]:
         url = get_day_url(date, area)
 
         cached = False
-        times = {}
-        redis_key = f'room_entries:{date.strftime("%y-%m-%d")}:{area}'
+        times = Grid()
+        redis_key = get_room_entries_key(date, area)
+        version_key = get_room_entries_version_key(date, area)
+        if current_span():
+            current_span().set(date=date.strftime('%y-%m-%d'), area=area)
         if not cookies:
-            cached_data = redis.get(redis_key)
-            times_data = json.loads(cached_data) if cached_data else None
-            if times_data:
-                for daytime, entries in times_data.items():
-                    for entry in entries:
-                        entry['state'] = State(entry['state'])
-                    times[int(daytime)] = entries
-                    cached = True
-
-        if not times:
-            r = self.get_request(url, cookies=cookies)
-            b = bs4.BeautifulSoup(r.text, 'lxml')
+            l1_entry = self.get_l1_room_entries(redis_key)
+            if l1_entry and l1_entry[0] > time.monotonic():
+                count_cache('room_entries_l1', 'hit')
+                return l1_entry[1], True
+            count_cache('room_entries_l1', 'stale' if l1_entry else 'miss')
+
+            # The grid is kept for a day to revalidate it, the version key tells whether it is still fresh
+            with span('cache.get', key=redis_key):
+                pipe = cache.pipeline()
+                pipe.get(redis_key)
+                pipe.ttl(version_key)
+                cached_data, ttl = pipe.execute()
+            if cached_data:
+                times = Grid.from_json(json.loads(cached_data))
+            if times and ttl > 0:
+                cached = True
+                self.set_l1_room_entries(redis_key, times, ttl)
+            count_cache('room_entries', 'hit' if cached else 'stale' if times else 'miss')
+
+        if not cached:
+            stale_times = times
+            validators_key = get_room_entries_validators_key(date, area)
+            validators = {}
+            headers = {}
+            if stale_times:
+                validators_json = cache.get(validators_key)
+                validators = json.loads(validators_json) if validators_json else {}
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    headers['If-Modified-Since'] = validators['last_modified']
+            try:
+                r = self.get_request(url, cookies=cookies, extra_headers=headers)
+            except (UpstreamUnavailable, requests.RequestException) as e:
+                if not stale_times:
+                    raise
+                # Better outdated seats than none while the library server is failing
+                logging.warning(f'Cache: serving expired room entries on {date.date()} for {self.areas[area]}: {e}')
+                count_cache('room_entries', 'stale_served')
+                return stale_times, True
 
             try:
-                table = b.find(id="day_main")
-
-                labels = [(list(t.strings)[1], t.attrs['data-room'])
-                          for t in list(table.thead.children)[1]
-                          if type(t) == bs4.element.Tag
-                          and 'data-room' in t.attrs]
-
-                rows = [r for r in table.tbody.children
-                        if type(r) == bs4.element.Tag
-                        and ('even_row' in r.attrs["class"] or 'odd_row' in r.attrs["class"])]
-                rows[0].td.find(class_='celldiv').text.strip()
-
-                times = {}
-                row_index = 0
-                for row in rows:
-                    row_entries = []
-                    col_index = 0
-                    row_label = 'N/A'
-                    daytime = self.daytimes[0]
-                    for column in row.find_all('td'):
-                        classes = column.attrs["class"]
-                        if 'row_labels' in classes:
-                            row_label = column.find(class_='celldiv').text.strip()
-                            # daytime = Daytime.MORNING if row_label == 'vormittags' else \
-                            #     Daytime.AFTERNOON if row_label == 'nachmittags' else \
-                            #         Daytime.EVENING
-                            #daytime = self.daytimes[row_label]
-
-                            continue
-                        state = 'new' in classes and State.FREE or \
-                                'private' in classes and State.OCCUPIED or \
-                                'writable' in classes and State.MINE or \
-                                State.UNKNOWN
-                        occupier = state in [State.FREE, State.MINE] and None or \
-                                   'I' in classes and 'Interne Buchungen' or \
-                                   'K' in classes and 'KIT Studenten' or \
-                                   'D' in classes and 'DHBW Studenten' or \
-                                   'H' in classes and 'HsKa Studenten' or \
-                                   'G' in classes and 'Private Buchungen' or \
-                                   'P' in classes and 'Personal' or \
-                                   'special'
-                        div = column.div
-                        entry_id = div.attrs['data-id'] if 'data-id' in div.attrs else None
-
-                        label = labels[col_index]
-                        row_entries.append({
-                            'area': area,
-                            'seat': label[0],
-                            'room_id': label[1],
-                            'state': state,
-                            'occupier': occupier,
-                            'entry_id': entry_id
-                        })
-                        col_index += 1
-                    times[row_index] = row_entries
-                    row_index += 1
-
-                free_seats_min = min(len([entry for entry in entries if entry['state'] == State.FREE])
-                                     for row_index, entries in times.items())
-                total_seats = min(len([entry for entry in entries])
-                                     for row_index, entries in times.items())
-
-                # Adaptive expiry time for quick updates at important times
-                expiry_time = 10 * 60
+                # Skip parsing and storing the grid again if it did not change
+                content_hash = None
+                unchanged = False
+                if r.status_code == 304 and validators:
+                    PARSE_SKIPS.labels('day.php', 'not_modified').inc()
+                    unchanged = True
+                else:
+                    content_hash = hash_day_page(r.text)
+                    if validators and content_hash == validators.get('hash'):
+                        PARSE_SKIPS.labels('day.php', 'same_hash').inc()
+                        unchanged = True
+
+                if unchanged:
+                    times = stale_times
+                else:
+                    with span('parse', page='day.php'):
+                        times = parse_room_entries(r.text, area)
+
+                index = SeatIndex.from_grid(times)
+                free_seats_min = min(index.free_count(daytime) for daytime in range(len(times)))
+                total_seats = min(index.totals)
+                content_hash = content_hash or validators.get('hash')
+
                 now = datetime.datetime.now()
-                if free_seats_min == 0:
-                    expiry_time = 30
-                elif free_seats_min < 5 and total_seats >= 10:
-                    expiry_time = 10
-                elif free_seats_min < 10 and total_seats >= 20:
-                    expiry_time = 25
-                elif free_seats_min < 15 and total_seats >= 30:
-                    expiry_time = 2 * 60
-                # Times when unused bookings are freed / new day comes
-                elif date.date() == now.date() and now.hour in [23] + list(range(8, 19)):
-                    minutes_to_next_half_hour = 30 - now.minute % 30
-                    if minutes_to_next_half_hour == 0:
-                        expiry_time = 60 - now.second
-                    else:
-                        expiry_time = min(5 * 60,  minutes_to_next_half_hour * 60)
-                elif date.date() - now.date() >= datetime.timedelta(days=2):
-                    expiry_time = 15 * 60
-                expiry_time = max(0, expiry_time + random.randrange(-5, 5))
-                logging.info(f'Cache: reloaded room entries on {date.date()} for {self.areas[area]}, expires in {expiry_time} seconds')
-                redis.set(redis_key, json.dumps(times), ex=expiry_time)
+                if validators.get('fetched') and not cookies:
+                    self.expiry_policy.observe(date, area, not unchanged, time.time() - validators['fetched'], now)
+                expiry_time = self.expiry_policy.expiry_time(date, area, free_seats_min, total_seats, now)
+                record_refresh(date, area, content_hash, free_seats_min, total_seats, now)
+                EXPIRY_TIME.observe(expiry_time)
+                logging.info(f'Cache: {"revalidated" if unchanged else "reloaded"} room entries on {date.date()} '
+                             f'for {self.areas[area]}, expires in {expiry_time} seconds')
+                pipe = cache.pipeline()
+                if unchanged:
+                    # Same grid, so things rendered for its version stay valid as well
+                    version = validators['version']
+                    pipe.expire(redis_key, ROOM_ENTRIES_STALE_EXPIRY)
+                    pipe.expire(get_seat_index_key(date, area), ROOM_ENTRIES_STALE_EXPIRY)
+                else:
+                    # Every change gets a new version, so anything derived from the grid can be keyed on it
+                    version = cache.incr('room_entries_version')
+                    pipe.set(redis_key, json.dumps(times), ex=ROOM_ENTRIES_STALE_EXPIRY)
+                    pipe.set(get_seat_index_key(date, area), json.dumps(index.to_json()), ex=ROOM_ENTRIES_STALE_EXPIRY)
+                pipe.set(validators_key, json.dumps({
+                    'etag': r.headers.get('ETag') or validators.get('etag'),
+                    'last_modified': r.headers.get('Last-Modified') or validators.get('last_modified'),
+                    'hash': content_hash,
+                    'version': version,
+                    'fetched': time.time(),
+                }), ex=ROOM_ENTRIES_STALE_EXPIRY)
+                self.add_seat_summary(pipe, date, area, index, expiry_time)
+                pipe.set(version_key, version, ex=expiry_time)
+                pipe.execute()
+                if not cookies:
+                    self.set_l1_room_entries(redis_key, times, expiry_time)
+                    self.set_l1_room_entries(get_seat_index_key(date, area), index, expiry_time)
             except Exception as e:
                 with open('last-error-room-entries.log', 'w') as f:
                     f.write(str(e) + '\n\n')
                     f.write(traceback.format_exc() + '\n\n')
-                    f.write(str(b) + '\n\n')
+                    f.write(r.text + '\n\n')
                     f.write(str(r) + '\n')
 
         return times, cached
 
+    @traced('get_seat_index')
+    def get_seat_index(self, date: datetime.datetime, area) -> tuple[SeatIndex, bool]:
+        """Free and occupied seats of an area, without loading the full grid if the index is cached."""
+        index_key = get_seat_index_key(date, area)
+        l1_entry = self.get_l1_room_entries(index_key)
+        if l1_entry and l1_entry[0] > time.monotonic():
+            count_cache('seat_index_l1', 'hit')
+            return l1_entry[1], True
+        count_cache('seat_index_l1', 'stale' if l1_entry else 'miss')
+
+        pipe = cache.pipeline()
+        pipe.get(index_key)
+        pipe.ttl(get_room_entries_version_key(date, area))
+        cached_data, ttl = pipe.execute()
+        count_cache('seat_index', 'hit' if cached_data and ttl > 0 else 'stale' if cached_data else 'miss')
+        # While the library server is failing, an expired index is as good as the expired grid behind it
+        if cached_data and (ttl > 0 or self.circuit.is_open):
+            index = SeatIndex.from_json(json.loads(cached_data))
+            self.set_l1_room_entries(index_key, index, ttl)
+            return index, True
+
+        times, cached = self.get_room_entries(date, area)
+        if not cached:
+            # Freshly loaded, get_room_entries stored the index already
+            l1_entry = self.get_l1_room_entries(index_key)
+            if l1_entry:
+                return l1_entry[1], False
+        return SeatIndex.from_grid(times), cached
+
+    def add_seat_summary(self, pipe, date: datetime.datetime, area, index: SeatIndex, expiry_time: int):
+        """Update the entries of the area in the summaries of all daytimes of the date"""
+        expires = time.time() + expiry_time
+        for daytime in range(max(len(self.daytimes), len(index.totals))):
+            entry = {'expires': expires}
+            if index.has_daytime(daytime):
+                entry.update(free=index.free_count(daytime), total=index.total(daytime),
+                             seats=index.free_seats(daytime, SUMMARY_SEATS))
+            summary_key = get_seat_summary_key(date, daytime)
+            pipe.hset(summary_key, area, json.dumps(entry))
+            # Entries expire on their own, the hash only has to outlive the day
+            pipe.expire(summary_key, 2 * 24 * 3600)
+
+    @traced('get_seat_summary')
+    def get_seat_summary(self, date: datetime.datetime, daytime: int) -> dict:
+        """Free seats of every area having the daytime, from one read of the summary.
+
+        Areas missing in the summary or expired are loaded from their index, which refreshes them. Areas
+        failing to load, e.g. without a cached grid while the library server is down, are left out.
+        """
+        entries = cache.hgetall(get_seat_summary_key(date, daytime))
+        now = time.time()
+        summary = {}
+        error = None
+        for area in self.areas:
+            data = entries.get(area.encode())
+            entry = json.loads(data) if data else None
+            if entry and entry['expires'] > now:
+                count_cache('seat_summary', 'hit')
+                if 'free' in entry:
+                    summary[area] = SummaryEntry(entry['free'], entry['total'],
+                                                 [tuple(seat) for seat in entry['seats']], True)
+                continue
+            count_cache('seat_summary', 'stale' if entry else 'miss')
+            try:
+                index, cached = self.get_seat_index(date, area)
+            except (UpstreamUnavailable, requests.RequestException) as e:
+                logging.warning(f'Summary: leaving out {self.areas[area]} on {date.date()}: {e}')
+                error = e
+                continue
+            if index.has_daytime(daytime):
+                summary[area] = SummaryEntry(index.free_count(daytime), index.total(daytime),
+                                             index.free_seats(daytime, SUMMARY_SEATS), cached)
+        if error and not summary:
+            # Nothing to show at all
+            raise error
+        return summary
+
+    def get_l1_room_entries(self, redis_key: str) -> tuple[float, Grid|SeatIndex]|None:
+        """(monotonic expiry, room entries or index) kept in process, expired ones included"""
+        with self.l1_lock:
+            return self.room_entries_l1.get(redis_key)
+
+    def set_l1_room_entries(self, redis_key: str, times: Grid|SeatIndex, ttl: int):
+        """Keep room entries or their index in process for a few seconds, but never longer than they are cached in redis."""
+        now = time.monotonic()
+        expiry_time = min(ROOM_ENTRIES_L1_EXPIRY, ttl) if ttl and ttl > 0 else 0
+        if expiry_time <= 0:
+            return
+        with self.l1_lock:
+            # Drop expired entries, so old days do not pile up
+            for key in [k for k, (expires, _) in self.room_entries_l1.items() if expires <= now]:
+                self.room_entries_l1.pop(key, None)
+            self.room_entries_l1[redis_key] = (now + expiry_time, times)
+
     def get_day_entries(self, date: datetime.datetime, areas=None, cookies: RequestsCookieJar = None) -> dict:
         entries = {}
         areas = areas if areas else [a for a in self.areas.keys()]
@@ -333,46 +542,143 @@ class Backend:
             })
         return entries
 
+    @traced('search_bookings')
     def search_bookings(self, start_day: datetime.datetime = datetime.datetime.today() + datetime.timedelta(days=1),
                         day_count=1,
                         state=None,
                         daytimes=None,
                         areas: list = None,
-                        cookies: RequestsCookieJar = None) -> list[dict]:
-        bookings = []
-
-        def time_bookings(time_entries: list, daytime, cached=False):
-            for seat in time_entries:
-                if not state or seat["state"] == state:
-                    bookings.append({
-                        'date': date,
-                        'daytime': daytime,
-                        'seat': seat,
-                        'state': seat["state"],
-                        'room': room_name,
-                        'area': seat['area'],
-                        'cached': cached
-                    })
-
+                        cookies: RequestsCookieJar = None) -> list[Booking]:
+        return list(self.iter_bookings(start_day, day_count, state, daytimes, areas, cookies))
+
+    def iter_bookings(self, start_day: datetime.datetime = datetime.datetime.today() + datetime.timedelta(days=1),
+                      day_count=1,
+                      state=None,
+                      daytimes=None,
+                      areas: list = None,
+                      cookies: RequestsCookieJar = None):
+        """The bookings of search_bookings one at a time, loading one day after the other"""
         for date in rrule.rrule(rrule.DAILY, count=day_count, dtstart=start_day):
             day_entries = self.get_day_entries(date, areas=areas, cookies=cookies)
             for room_name, (room_entries, cached) in day_entries.items():
                 if daytimes is None:
-                    for time_name, time_entries in room_entries.items():
-                        time_bookings(time_entries, time_name, cached)
+                    rows = room_entries.items()
                 else:
                     # if isinstance(daytimes, type(self.daytimes)):
                     #     daytimes = [daytimes]
                     # elif all(isinstance(d, int) for d in daytimes):
                     #     daytimes = [repr(self.daytimes(d)) for d in daytimes]
-                    for daytime in daytimes:
-                        if daytime < len(room_entries):
-                            time_bookings(room_entries[daytime], daytime, cached)
-
-        return bookings
+                    rows = [(daytime, room_entries[daytime]) for daytime in daytimes if daytime < len(room_entries)]
+                for daytime, time_entries in rows:
+                    for seat in time_entries:
+                        if not state or seat.state == state:
+                            yield Booking(date, daytime, seat, room_name, cached)
 
     def book_seat(self, user_id, day_delta: int, daytime: int, room, seat, room_id, cookies: RequestsCookieJar) -> (bool, str):
-        date = datetime.datetime.today() + datetime.timedelta(days=int(day_delta))
+        success, msg = self.timed_booking(user_id, day_delta, daytime, room, seat, room_id, cookies)
+        if success:
+            self.invalidate_room_entries([(get_booking_date(day_delta), room)])
+        return success, msg
+
+    @traced('book_seats')
+    def book_seats(self, user_id, targets: list[dict], cookies: RequestsCookieJar) -> list[tuple[bool, str]]:
+        """Book several seats at once, e.g. one seat for all daytimes of a day.
+
+        Targets are dicts with the arguments of book_seat. They are submitted concurrently with the same
+        login, so the batch takes about as long as a single booking. Returns (success, msg) per target.
+        """
+        results = [None] * len(targets)
+        pending = []
+        slots = set()
+        for i, target in enumerate(targets):
+            # The library allows one seat per daytime, the second one would only be rejected upstream
+            slot = (int(target['day_delta']), int(target['daytime']))
+            if slot in slots:
+                results[i] = (False, 'Zu dieser Zeit ist schon ein anderer Platz ausgewählt')
+            else:
+                slots.add(slot)
+                pending.append(i)
+
+        def book(target):
+            try:
+                return self.timed_booking(user_id, cookies=cookies, **target)
+            except Exception as e:
+                logging.exception(f'Booking {target} failed')
+                return False, str(e)
+
+        for i, result in zip(pending, map_concurrently(book, [targets[i] for i in pending], BOOKING_CONCURRENCY)):
+            results[i] = result
+
+        booked = {(int(target['day_delta']), target['room']) for target, (success, _) in zip(targets, results) if success}
+        self.invalidate_room_entries([(get_booking_date(day_delta), area) for day_delta, area in booked])
+        return results
+
+    def get_reserved_slots(self, user_id, cookies: RequestsCookieJar) -> set[tuple[int, int]]:
+        """(day_delta, daytime) of the user's reservations from today on, empty if they cannot be loaded"""
+        reservations = self.get_reservations(user_id, cookies) or []
+        daytimes = {daytime['name'].lower(): daytime['index'] for daytime in self.daytimes}
+        today = datetime.date.today()
+        slots = set()
+        for r in reservations:
+            if 'day' in r and r.get('daytime', '').lower() in daytimes:
+                day_delta = (datetime.date.fromisoformat(r['day']) - today).days
+                slots.add((day_delta, daytimes[r['daytime'].lower()]))
+        return slots
+
+    @traced('cancel_reservations')
+    def cancel_reservations(self, user_id, cookies: RequestsCookieJar, day: str = None) \
+            -> list[tuple[dict, bool]]|None:
+        """Cancel all reservations of the user, or those on day (YYYY-MM-DD).
+
+        The reservations are looked up once and deleted concurrently. Returns (reservation, success)
+        per reservation, None if the reservations could not be loaded.
+        """
+        reservations = self.get_reservations(user_id, cookies)
+        if reservations is None:
+            return None
+        if day:
+            reservations = [r for r in reservations if r.get('day') == day]
+
+        def cancel(reservation):
+            try:
+                return self.cancel_reservation(user_id, reservation['id'], cookies)[0]
+            except Exception:
+                logging.exception(f"Cancelling {reservation['id']} failed")
+                return False
+
+        results = list(zip(reservations, map_concurrently(cancel, reservations, BOOKING_CONCURRENCY)))
+        area_ids = {name: area for area, name in self.areas.items()}
+        cancelled = {(r['day'], area_ids[r['room']]) for r, success in results
+                     if success and 'day' in r and r['room'] in area_ids}
+        self.invalidate_room_entries([(datetime.datetime.strptime(day, '%Y-%m-%d'), area) for day, area in cancelled])
+        return results
+
+    def timed_booking(self, user_id, day_delta: int, daytime: int, room, seat, room_id, cookies: RequestsCookieJar) -> (bool, str):
+        start = time.perf_counter()
+        success, msg = self.submit_booking(user_id, day_delta, daytime, room, seat, room_id, cookies)
+        BOOKING_DURATION.labels('success' if success else 'failed').observe(time.perf_counter() - start)
+        return success, msg
+
+    def invalidate_room_entries(self, grids: list[tuple[datetime.datetime, str]]):
+        """Expire the cached grids of (date, area), e.g. after booking on them, so the next read reloads them.
+
+        The grids are kept to revalidate them, only their version and summary entries are dropped.
+        """
+        if not grids:
+            return
+        pipe = cache.pipeline()
+        for date, area in grids:
+            pipe.delete(get_room_entries_version_key(date, area))
+            for daytime in range(len(self.daytimes)):
+                pipe.hdel(get_seat_summary_key(date, daytime), area)
+        with self.l1_lock:
+            for date, area in grids:
+                self.room_entries_l1.pop(get_room_entries_key(date, area), None)
+                self.room_entries_l1.pop(get_seat_index_key(date, area), None)
+        pipe.execute()
+
+    def submit_booking(self, user_id, day_delta: int, daytime: int, room, seat, room_id, cookies: RequestsCookieJar) -> (bool, str):
+        date = get_booking_date(day_delta)
         creds = get_user_creds(user_id)
         user = creds['user']
         daytime = int(daytime)
@@ -424,6 +730,7 @@ class Backend:
             msg = check_result['rules_broken'][0] \
                 if check_result and 'rules_broken' in check_result and check_result['rules_broken'] else None
             if not msg:
+                import bs4
                 page = bs4.BeautifulSoup(res.text, 'lxml')
 
                 content = page.find(id="contents")
@@ -497,26 +804,7 @@ class Backend:
         if res.status_code != 200:
             return None
 
-        data = json.loads(res.text)
-        entries = []
-        for j_entries in data['aaData']:
-            entry = {}
-            links = j_entries[0]
-            b = bs4.BeautifulSoup(links, 'lxml')
-            entry['id'] = b.a.attrs['data-id']
-            entry['room'] = j_entries[1]
-            entry['seat'] = j_entries[2]
-
-            b = bs4.BeautifulSoup(j_entries[3], 'lxml')
-            date = b.get_text().title()
-            m = re.match('(?P<daytime>[A-Za-z]+), (?P<weekday>[A-Za-z]+) '
-                     '(?P<day>[0-9]{2}) (?P<month>[A-Za-z]+) (?P<year>[0-9]{4})', date)
-            if m:
-                date = f"{m.group('weekday')}, {m.group('day')}. {m.group('month')}"
-                entry['daytime'] = m.group('daytime')
-            entry['date'] = date
-            entries.append(entry)
-        return entries
+        return parse_reservations(res.text)
 
         # b = bs4.BeautifulSoup(res.text, 'lxml')
         # table = b.find(id="report_table")
@@ -547,18 +835,68 @@ class Backend:
                 cookies: RequestsCookieJar = None,
                 params: dict = None,
                 referer: str = None,
+                extra_headers: dict = None,
                 **kwargs):
         url = self.get_absolute_url(suburl)
+        endpoint = get_endpoint(url)
+        permit = self.circuit.allow()
+        if not permit:
+            UPSTREAM_REQUESTS.labels(endpoint, method, 'circuit_open').inc()
+            raise UpstreamUnavailable()
+        kwargs.setdefault('timeout', get_timeout(endpoint))
+        retries = UPSTREAM_RETRIES if is_idempotent(method, endpoint) else 0
+        attempt = 0
+        while True:
+            error = None
+            try:
+                hedge_delay = self.latencies.hedge_delay(endpoint) if method == 'GET' else None
+                if hedge_delay is not None:
+                    res = self.send_hedged(hedge_delay, url, method, cookies, params, referer, extra_headers, **kwargs)
+                else:
+                    res = self.send(url, method, cookies, params, referer, extra_headers, **kwargs)
+            except Exception as e:
+                error = e
+            self.circuit.record(error is None and res.status_code < 500, probe=permit == PROBE)
+            if error is None and res.status_code not in RETRY_STATUS:
+                return res
+            if attempt >= retries or (error and not isinstance(error, requests.RequestException)):
+                if error:
+                    raise error
+                return res
+            attempt += 1
+            permit = self.circuit.allow()
+            if not permit:
+                raise UpstreamUnavailable()
+            logging.warning(f'Upstream: retrying {endpoint} after {error or res.status_code}')
+            UPSTREAM_RETRIES_TOTAL.labels(endpoint).inc()
+            time.sleep(random.uniform(0, UPSTREAM_BACKOFF * 2 ** attempt))
+
+    def send(self,
+             url: str,
+             method: str,
+             cookies: RequestsCookieJar = None,
+             params: dict = None,
+             referer: str = None,
+             extra_headers: dict = None,
+             **kwargs):
+        """A single attempt of a request"""
         session = requests.session()
-        if self.proxy:
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        proxy = pinned_key = None
+        # Only sessions are pinned, not every anonymous request the server hands a new one to
+        has_session = bool(cookies)
+        if self.proxies:
+            proxy, pinned_key = self.proxies.choose(cookies)
             session.proxies.update({
-                'http': self.proxy,
-                'https': self.proxy
+                'http': proxy,
+                'https': proxy
             })
         if cookies:
             session.cookies = cookies
         headers = {
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+            'Accept-Encoding': ACCEPT_ENCODING,
             'Accept-Language': 'de_DE,en;q=0.5',
             'Connection': 'keep-alive',
             'Origin': self.base_url,
@@ -566,38 +904,307 @@ class Backend:
         }
         if referer:
             headers['referer'] = referer
+        headers.update(extra_headers or {})
 
-        res = session.request(method=method, url=url, params=params, headers=headers, **kwargs)
+        endpoint = get_endpoint(url)
+        start = time.perf_counter()
+        try:
+            with span('upstream', endpoint=endpoint, method=method) as upstream_span:
+                res = session.request(method=method, url=url, params=params, headers=headers, **kwargs)
+                # As transferred, before decompressing
+                wire_bytes = res.raw.tell() if hasattr(res.raw, 'tell') else len(res.content)
+                UPSTREAM_BYTES.labels(endpoint).inc(wire_bytes)
+                if upstream_span:
+                    upstream_span.set(status=res.status_code, bytes=len(res.content), wire_bytes=wire_bytes)
+        except Exception:
+            UPSTREAM_REQUESTS.labels(endpoint, method, 'error').inc()
+            if proxy:
+                self.proxies.release(proxy, time.perf_counter() - start, ok=False)
+            raise
+        finally:
+            UPSTREAM_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+        UPSTREAM_REQUESTS.labels(endpoint, method, res.status_code).inc()
+        if res.status_code < 500:
+            self.latencies.record(endpoint, time.perf_counter() - start)
         # Overwrite old cookies with new cookies
         session.cookies.update(res.cookies)
         res.cookies = session.cookies
+        if proxy:
+            # Errors of the library server are not the fault of the proxy
+            self.proxies.release(proxy, time.perf_counter() - start, ok=True)
+            if has_session:
+                self.proxies.pin(session.cookies, proxy, pinned_key)
         return res
 
+    def send_hedged(self, delay: float, url: str, *args, **kwargs):
+        """Send the request a second time if it takes longer than delay seconds, the first answer wins"""
+        endpoint = get_endpoint(url)
+        first = self.hedge_executor.submit(contextvars.copy_context().run, self.send, url, *args, **kwargs)
+        done, _ = concurrent.futures.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        hedge = self.hedge_executor.submit(contextvars.copy_context().run, self.send, url, *args, **kwargs)
+        pending = {first, hedge}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    UPSTREAM_HEDGES.labels(endpoint, 'first' if future is first else 'hedge').inc()
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def probe_proxy(self, proxy: str) -> bool:
+        """Whether the library server can be reached through the proxy again"""
+        res = requests.get(self.base_url, proxies={'http': proxy, 'https': proxy}, timeout=METADATA_TIMEOUT)
+        return res.status_code < 500
+
     def get_absolute_url(self, suburl):
         return urljoin(self.base_url, suburl)
 
 
+@PARSE_DURATION.labels('landing').time()
+def parse_areas(html: str) -> dict:
+    import bs4
+    b = bs4.BeautifulSoup(html, 'lxml')
+    area_div = b.find('div', id='dwm_areas')
+    areas = {}
+    for li in area_div.find_all('li'):
+        name = li.text.strip()
+        url = urllib.parse.urlparse(li.a.get('href'))
+        params = urllib.parse.parse_qs(url.query)
+        number = ''.join(params['area'])
+        areas[number] = name
+    return areas
+
+
+@PARSE_DURATION.labels('landing').time()
+def parse_daytimes(html: str) -> list:
+    import bs4
+    b = bs4.BeautifulSoup(html, 'lxml')
+    table = b.find(id="day_main")
+
+    rows = [r for r in table.tbody.children
+            if type(r) == bs4.element.Tag
+            and ('even_row' in r.attrs["class"] or 'odd_row' in r.attrs["class"])]
+    daytimes = []
+    index = 0
+    for row in rows:
+        link = row.div.a
+        href = link.attrs['href']
+        seconds_match = re.search('timetohighlight=(.*)$', href)
+        seconds = seconds_match.group(1)
+        name = link.text
+        daytimes.append({
+            'name': name,
+            'seconds': seconds,
+            'index': index
+        })
+        index += 1
+    return daytimes
+
+
+# The report names months in English, whatever the locale of the bot is
+REPORT_MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+                 'November', 'December']
+
+
+@PARSE_DURATION.labels('report.php').time()
+def parse_reservations(text: str) -> list[dict]:
+    import bs4
+    data = json.loads(text)
+    entries = []
+    for j_entries in data['aaData']:
+        entry = {}
+        links = j_entries[0]
+        b = bs4.BeautifulSoup(links, 'lxml')
+        entry['id'] = b.a.attrs['data-id']
+        entry['room'] = j_entries[1]
+        entry['seat'] = j_entries[2]
+
+        b = bs4.BeautifulSoup(j_entries[3], 'lxml')
+        date = b.get_text().title()
+        m = re.match('(?P<daytime>[A-Za-z]+), (?P<weekday>[A-Za-z]+) '
+                 '(?P<day>[0-9]{2}) (?P<month>[A-Za-z]+) (?P<year>[0-9]{4})', date)
+        if m:
+            date = f"{m.group('weekday')}, {m.group('day')}. {m.group('month')}"
+            entry['daytime'] = m.group('daytime')
+            if m.group('month') in REPORT_MONTHS:
+                month = REPORT_MONTHS.index(m.group('month')) + 1
+                entry['day'] = f"{m.group('year')}-{month:02d}-{m.group('day')}"
+        entry['date'] = date
+        entries.append(entry)
+    return entries
+
+
+@PARSE_DURATION.labels('admin.php').time()
+def parse_captcha_url(html: str) -> str|None:
+    import bs4
+    b = bs4.BeautifulSoup(html, 'lxml')
+    captcha_div = b.find('div', attrs={'id': 'Captcha'})
+    if not captcha_div:
+        return None
+    captcha_img = captcha_div.img
+    if not captcha_img or 'src' not in captcha_img.attrs:
+        return None
+    return captcha_img.attrs['src']
+
+
+@PARSE_DURATION.labels('day.php').time()
+def parse_room_entries(html: str, area) -> Grid:
+    import bs4
+    b = bs4.BeautifulSoup(html, 'lxml')
+    table = b.find(id="day_main")
+
+    # Plain strings, a NavigableString would keep the whole parsed page alive with the grid
+    labels = [(sys.intern(str(list(t.strings)[1])), sys.intern(str(t.attrs['data-room'])))
+              for t in list(table.thead.children)[1]
+              if type(t) == bs4.element.Tag
+              and 'data-room' in t.attrs]
+
+    rows = [r for r in table.tbody.children
+            if type(r) == bs4.element.Tag
+            and ('even_row' in r.attrs["class"] or 'odd_row' in r.attrs["class"])]
+    rows[0].td.find(class_='celldiv').text.strip()
+
+    times = []
+    for row in rows:
+        row_entries = []
+        col_index = 0
+        for column in row.find_all('td'):
+            classes = column.attrs["class"]
+            if 'row_labels' in classes:
+                continue
+            state = 'new' in classes and State.FREE or \
+                    'private' in classes and State.OCCUPIED or \
+                    'writable' in classes and State.MINE or \
+                    State.UNKNOWN
+            occupier = state in [State.FREE, State.MINE] and None or \
+                       'I' in classes and 'Interne Buchungen' or \
+                       'K' in classes and 'KIT Studenten' or \
+                       'D' in classes and 'DHBW Studenten' or \
+                       'H' in classes and 'HsKa Studenten' or \
+                       'G' in classes and 'Private Buchungen' or \
+                       'P' in classes and 'Personal' or \
+                       'special'
+            div = column.div
+            entry_id = div.attrs['data-id'] if 'data-id' in div.attrs else None
+
+            label = labels[col_index]
+            row_entries.append(Seat(area, label[0], label[1], state, occupier, entry_id))
+            col_index += 1
+        times.append(row_entries)
+    return Grid.from_rows(times)
+
+
+def read_metadata_snapshot() -> dict|None:
+    try:
+        with open(METADATA_SNAPSHOT) as f:
+            snapshot = json.load(f)
+        if snapshot.get('areas') and snapshot.get('daytimes'):
+            return snapshot
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f'Could not read metadata snapshot {METADATA_SNAPSHOT}: {e}')
+    return None
+
+
+def write_metadata_snapshot(areas: dict, daytimes: list):
+    try:
+        # A temporary file of its own, instances sharing the data volume may write at the same time
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(METADATA_SNAPSHOT) or '.',
+                                         prefix=os.path.basename(METADATA_SNAPSHOT) + '.', suffix='.tmp',
+                                         delete=False) as f:
+            json.dump({
+                'areas': areas,
+                'daytimes': daytimes,
+                'saved': datetime.datetime.now().isoformat(timespec='seconds')
+            }, f)
+        try:
+            os.replace(f.name, METADATA_SNAPSHOT)
+        except OSError:
+            os.unlink(f.name)
+            raise
+    except OSError as e:
+        logging.warning(f'Could not write metadata snapshot {METADATA_SNAPSHOT}: {e}')
+
+
 def get_day_url(date: datetime.datetime, area) -> str:
     return f'day.php?year={date.year}&month={date.month}&day={date.day}&area={area}'
 
 
+def map_concurrently(fn, items: list, max_workers: int) -> list:
+    """fn applied to every item in up to max_workers threads, results in the order of the items."""
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        # Keep the current span in the workers, so their requests show up in the trace of the update.
+        # A context can only be entered by one thread at a time, so every item gets its own copy.
+        contexts = [contextvars.copy_context() for _ in items]
+        return list(executor.map(lambda context, item: context.run(fn, item), contexts, items))
+
+
+def get_booking_date(day_delta: int) -> datetime.datetime:
+    return datetime.datetime.today() + datetime.timedelta(days=int(day_delta))
+
+
+def get_room_entries_key(date: datetime.datetime, area) -> str:
+    return f'room_entries:{date.strftime("%y-%m-%d")}:{area}'
+
+
+def get_seat_index_key(date: datetime.datetime, area) -> str:
+    return f'seat_index:{date.strftime("%y-%m-%d")}:{area}'
+
+
+def get_seat_summary_key(date: datetime.datetime, daytime: int) -> str:
+    return f'seat_summary:{date.strftime("%y-%m-%d")}:{daytime}'
+
+
+def get_room_entries_validators_key(date: datetime.datetime, area) -> str:
+    return f'room_entries_validators:{date.strftime("%y-%m-%d")}:{area}'
+
+
+def hash_day_page(html: str) -> str:
+    """Hash of the seat table, the rest of the page may change without the seats changing."""
+    start = html.find('id="day_main"')
+    end = html.find('</table>', start)
+    content = html[start:end] if start >= 0 and end >= 0 else html
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def get_room_entries_version_key(date: datetime.datetime, area) -> str:
+    return f'room_entries_version:{date.strftime("%y-%m-%d")}:{area}'
+
+
+def get_room_entries_version(date: datetime.datetime, areas) -> str|None:
+    """Combined cache version of the room entries of all areas on a day.
+
+    Returns None if any of the grids is not cached, as there is nothing stable to key on then.
+    """
+    versions = cache.mget([get_room_entries_version_key(date, area) for area in areas])
+    if not versions or any(v is None for v in versions):
+        return None
+    return '-'.join(v.decode() for v in versions)
+
+
 def get_user_creds(user_id) -> dict:
     creds_key = f'login-creds:{user_id}'
-    creds_json = redis.get(creds_key)
+    creds_json = get_user_cache().get(creds_key)
     creds = json.loads(creds_json) if creds_json else None
     return creds
 
 
 def set_user_creds(user_id, data):
     creds_key = f'login-creds:{user_id}'
-    redis.set(creds_key, json.dumps(data))
+    get_user_cache().set(creds_key, json.dumps(data))
 
 
 def remove_user_creds(user_id):
     creds_key = f'login-creds:{user_id}'
-    redis.delete(creds_key)
     cookies_key = f'login-cookies:{user_id}'
-    redis.delete(cookies_key)
+    get_user_cache().delete(creds_key, cookies_key)
 
 
 def markdown_strip_characters(text):
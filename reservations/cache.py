@@ -0,0 +1,408 @@
+"""Cache backends offering the subset of the redis interface the bot uses.
+
+CACHE_BACKEND selects the implementation:
+- redis (default): shared redis server, configured by REDIS_HOST, REDIS_PORT and REDIS_DB
+- memory: in the process, for single-instance deployments without redis
+- sqlite: in a local SQLite file at CACHE_PATH, which survives restarts
+
+All of them store bytes like redis does, str and numbers are encoded, and expiry times (`ex`) are
+whole seconds greater than zero. Besides strings there are hashes, which expire as a whole. ttl()
+returns -2 for missing keys and -1 for keys without expiry.
+"""
+import abc
+import os
+import sqlite3
+import threading
+import time
+
+
+class Cache(abc.ABC):
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes|None:
+        raise NotImplementedError
+
+    def mget(self, keys: list) -> list:
+        return [self.get(key) for key in keys]
+
+    @abc.abstractmethod
+    def set(self, key: str, value, ex: int = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, *keys) -> int:
+        raise NotImplementedError
+
+    def exists(self, *keys) -> int:
+        return sum(1 for key in keys if self.ttl(key) != -2)
+
+    @abc.abstractmethod
+    def incr(self, key: str, amount: int = 1) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def expire(self, key: str, seconds: int) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ttl(self, key: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hset(self, key: str, field: str, value) -> int:
+        raise NotImplementedError
+
+    def hget(self, key: str, field: str) -> bytes|None:
+        return self.hgetall(key).get(encode(field))
+
+    @abc.abstractmethod
+    def hgetall(self, key: str) -> dict:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hdel(self, key: str, *fields) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def flushdb(self):
+        raise NotImplementedError
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+class Pipeline:
+    """Collects commands and runs them together on execute(), like a redis pipeline."""
+
+    def __init__(self, cache: Cache):
+        self.cache = cache
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self) -> list:
+        commands, self.commands = self.commands, []
+        return self.cache.execute_commands(commands)
+
+
+def encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value).encode()
+    if isinstance(value, str):
+        return value.encode()
+    raise TypeError(f'Invalid value of type {type(value).__name__}, convert to bytes, str or a number first')
+
+
+def check_expiry(ex):
+    if ex is not None and (not isinstance(ex, int) or ex <= 0):
+        raise ValueError(f'Invalid expire time {ex}, must be a positive number of seconds')
+
+
+class RedisCache(Cache):
+    def __init__(self):
+        import redis
+        self.pool = redis.BlockingConnectionPool(
+            host=os.environ.get('REDIS_HOST', 'localhost'),
+            port=int(os.environ.get('REDIS_PORT', 6379)),
+            db=int(os.environ.get('REDIS_DB', 0)),
+            max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 32)),
+            timeout=5)
+        self.client = redis.Redis(connection_pool=self.pool)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def mget(self, keys):
+        return self.client.mget(keys) if keys else []
+
+    def set(self, key, value, ex=None):
+        check_expiry(ex)
+        return self.client.set(key, encode(value), ex=ex)
+
+    def delete(self, *keys):
+        return self.client.delete(*keys) if keys else 0
+
+    def exists(self, *keys):
+        return self.client.exists(*keys)
+
+    def incr(self, key, amount=1):
+        return self.client.incr(key, amount)
+
+    def expire(self, key, seconds):
+        check_expiry(seconds)
+        return self.client.expire(key, seconds)
+
+    def ttl(self, key):
+        return self.client.ttl(key)
+
+    def hset(self, key, field, value):
+        return self.client.hset(key, field, encode(value))
+
+    def hget(self, key, field):
+        return self.client.hget(key, field)
+
+    def hgetall(self, key):
+        return self.client.hgetall(key)
+
+    def hdel(self, key, *fields):
+        return self.client.hdel(key, *fields) if fields else 0
+
+    def flushdb(self):
+        return self.client.flushdb()
+
+    def pipeline(self):
+        return self.client.pipeline()
+
+
+class MemoryCache(Cache):
+    def __init__(self):
+        # key -> (value, expiry as time.monotonic() or None)
+        self.data = {}
+        self.lock = threading.RLock()
+        self.operations = 0
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def _purge(self):
+        """Drop expired keys from time to time, reading only removes the keys it hits."""
+        self.operations += 1
+        if self.operations % 1000 == 0:
+            now = time.monotonic()
+            for key in [k for k, (_, expires) in self.data.items() if expires is not None and expires <= now]:
+                del self.data[key]
+
+    def get(self, key):
+        with self.lock:
+            entry = self._get(key)
+            return entry[0] if entry and isinstance(entry[0], bytes) else None
+
+    def set(self, key, value, ex=None):
+        check_expiry(ex)
+        with self.lock:
+            self._purge()
+            self.data[key] = (encode(value), time.monotonic() + ex if ex else None)
+            return True
+
+    def hset(self, key, field, value):
+        with self.lock:
+            self._purge()
+            entry = self._get(key)
+            if not entry or not isinstance(entry[0], dict):
+                entry = ({}, None)
+                self.data[key] = entry
+            field = encode(field)
+            added = field not in entry[0]
+            entry[0][field] = encode(value)
+            return int(added)
+
+    def hgetall(self, key):
+        with self.lock:
+            entry = self._get(key)
+            return dict(entry[0]) if entry and isinstance(entry[0], dict) else {}
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            entry = self._get(key)
+            if not entry or not isinstance(entry[0], dict):
+                return 0
+            removed = sum(1 for field in fields if entry[0].pop(encode(field), None) is not None)
+            if not entry[0]:
+                del self.data[key]
+            return removed
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(1 for key in keys if self._get(key) and self.data.pop(key))
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            entry = self._get(key)
+            if entry and not isinstance(entry[0], bytes):
+                raise TypeError(f'{key} is not a string')
+            value = int(entry[0]) + amount if entry else amount
+            self.data[key] = (encode(value), entry[1] if entry else None)
+            return value
+
+    def expire(self, key, seconds):
+        check_expiry(seconds)
+        with self.lock:
+            entry = self._get(key)
+            if not entry:
+                return False
+            self.data[key] = (entry[0], time.monotonic() + seconds)
+            return True
+
+    def ttl(self, key):
+        with self.lock:
+            entry = self._get(key)
+            if not entry:
+                return -2
+            if entry[1] is None:
+                return -1
+            return max(0, round(entry[1] - time.monotonic()))
+
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+
+    def execute_commands(self, commands):
+        with self.lock:
+            return [getattr(self, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+class SQLiteCache(Cache):
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+        # Every field of a hash carries the expiry of the whole hash
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes '
+                                '(key TEXT, field BLOB, value BLOB NOT NULL, expires REAL, PRIMARY KEY (key, field))')
+        self.lock = threading.RLock()
+        self.operations = 0
+
+    def _get(self, key):
+        row = self.connection.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row and row[1] is not None and row[1] <= time.time():
+            self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return None
+        return row
+
+    def _get_hash_expiry(self, key):
+        """Whether the hash exists and its expiry"""
+        row = self.connection.execute('SELECT expires FROM hashes WHERE key = ? LIMIT 1', (key,)).fetchone()
+        if row and row[0] is not None and row[0] <= time.time():
+            self.connection.execute('DELETE FROM hashes WHERE key = ?', (key,))
+            return False, None
+        return bool(row), row[0] if row else None
+
+    def _purge(self):
+        self.operations += 1
+        if self.operations % 1000 == 0:
+            self.connection.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+            self.connection.execute('DELETE FROM hashes WHERE expires <= ?', (time.time(),))
+
+    def get(self, key):
+        with self.lock:
+            row = self._get(key)
+            return bytes(row[0]) if row else None
+
+    def mget(self, keys):
+        with self.lock:
+            return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        check_expiry(ex)
+        with self.lock:
+            self._purge()
+            self.connection.execute('DELETE FROM hashes WHERE key = ?', (key,))
+            self.connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                                    (key, encode(value), time.time() + ex if ex else None))
+            return True
+
+    def hset(self, key, field, value):
+        with self.lock:
+            self._purge()
+            exists, expires = self._get_hash_expiry(key)
+            if not exists:
+                self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+            added = not self.connection.execute('SELECT 1 FROM hashes WHERE key = ? AND field = ?',
+                                                (key, encode(field))).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO hashes (key, field, value, expires) VALUES (?, ?, ?, ?)',
+                                    (key, encode(field), encode(value), expires))
+            return int(added)
+
+    def hgetall(self, key):
+        with self.lock:
+            if not self._get_hash_expiry(key)[0]:
+                return {}
+            rows = self.connection.execute('SELECT field, value FROM hashes WHERE key = ?', (key,)).fetchall()
+            return {bytes(field): bytes(value) for field, value in rows}
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            if not self._get_hash_expiry(key)[0]:
+                return 0
+            return sum(self.connection.execute('DELETE FROM hashes WHERE key = ? AND field = ?',
+                                               (key, encode(field))).rowcount for field in fields)
+
+    def delete(self, *keys):
+        with self.lock:
+            deleted = 0
+            for key in keys:
+                exists = self._get(key) or self._get_hash_expiry(key)[0]
+                self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.connection.execute('DELETE FROM hashes WHERE key = ?', (key,))
+                deleted += 1 if exists else 0
+            return deleted
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            row = self._get(key)
+            value = int(row[0]) + amount if row else amount
+            self.connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                                    (key, encode(value), row[1] if row else None))
+            return value
+
+    def expire(self, key, seconds):
+        check_expiry(seconds)
+        with self.lock:
+            if self._get(key):
+                self.connection.execute('UPDATE cache SET expires = ? WHERE key = ?', (time.time() + seconds, key))
+            elif self._get_hash_expiry(key)[0]:
+                self.connection.execute('UPDATE hashes SET expires = ? WHERE key = ?', (time.time() + seconds, key))
+            else:
+                return False
+            return True
+
+    def ttl(self, key):
+        with self.lock:
+            row = self._get(key)
+            if row:
+                expires = row[1]
+            else:
+                exists, expires = self._get_hash_expiry(key)
+                if not exists:
+                    return -2
+            if expires is None:
+                return -1
+            return max(0, round(expires - time.time()))
+
+    def flushdb(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM cache')
+            self.connection.execute('DELETE FROM hashes')
+
+    def execute_commands(self, commands):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                results = [getattr(self, name)(*args, **kwargs) for name, args, kwargs in commands]
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return results
+
+
+def create_cache() -> Cache:
+    backend = os.environ.get('CACHE_BACKEND', 'redis').lower()
+    if backend == 'redis':
+        return RedisCache()
+    elif backend == 'memory':
+        return MemoryCache()
+    elif backend == 'sqlite':
+        return SQLiteCache(os.environ.get('CACHE_PATH', 'cache.sqlite3'))
+    raise ValueError(f'Unknown CACHE_BACKEND {backend}, use redis, memory or sqlite')
@@ -0,0 +1,112 @@
+"""State of the user an update comes from, read from the cache in one round trip and written back in one.
+
+A handler used to read and write the login cookies, credentials and the temporary state of the
+conversation key by key, one round trip each. Within user_context(), the keys of USER_KEYS are read
+with a single mget on the first read of one of them, reads and writes of them go to the context, and
+the changes are written with a single pipeline when the update is done. Other keys pass through to
+the cache.
+"""
+import contextvars
+from contextlib import contextmanager
+
+from . import cache
+from .cache import encode, check_expiry
+from .tracing import span
+
+# Keys holding the state of a user, formatted with the user id
+USER_KEYS = [
+    'login-cookies:{}',
+    'login-creds:{}',
+    'temp:day_selected:{}',
+    'temp:login_username:{}',
+    'temp:login_password:{}',
+    'temp:login_cookies:{}',
+    'temp:captcha_next:{}',
+]
+
+_current = contextvars.ContextVar('user_context', default=None)
+
+
+class UserContext:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.keys = {key.format(user_id) for key in USER_KEYS}
+        # Loaded on the first read, handlers only writing, e.g. the selected day, need no read
+        self.values = None
+        # key -> (value, ex) to set, or None to delete
+        self.changes = {}
+
+    def load(self):
+        keys = list(self.keys)
+        with span('cache.mget', keys=len(keys)):
+            self.values = dict(zip(keys, cache.mget(keys)))
+        for key, change in self.changes.items():
+            self.values[key] = change[0] if change else None
+
+    def get(self, key: str) -> bytes|None:
+        if key not in self.keys:
+            return cache.get(key)
+        if self.values is None:
+            self.load()
+        return self.values[key]
+
+    def set(self, key: str, value, ex: int = None):
+        if key not in self.keys:
+            return cache.set(key, value, ex=ex)
+        # Fails here like the cache would, not when flushing
+        value = encode(value)
+        check_expiry(ex)
+        if self.values is not None:
+            self.values[key] = value
+        self.changes[key] = (value, ex)
+
+    def delete(self, *keys) -> int:
+        """Unlike the cache, counts only deleted keys already read, as it does not read them for this"""
+        others = [key for key in keys if key not in self.keys]
+        deleted = cache.delete(*others) if others else 0
+        for key in keys:
+            if key in self.keys:
+                if self.values is not None:
+                    deleted += self.values[key] is not None
+                    self.values[key] = None
+                self.changes[key] = None
+        return deleted
+
+    def exists(self, *keys) -> int:
+        return sum(1 for key in keys if self.get(key) is not None)
+
+    def flush(self):
+        """Write the changes in one round trip"""
+        if not self.changes:
+            return
+        changes, self.changes = self.changes, {}
+        with span('cache.pipeline', keys=len(changes)):
+            pipe = cache.pipeline()
+            for key, change in changes.items():
+                if change is None:
+                    pipe.delete(key)
+                else:
+                    value, ex = change
+                    pipe.set(key, value, ex=ex)
+            pipe.execute()
+
+
+@contextmanager
+def user_context(user_id):
+    """Keep the state of the user in a UserContext while handling an update, nested calls share it."""
+    context = _current.get()
+    if user_id is None or (context and context.user_id == user_id):
+        yield context
+        return
+    context = UserContext(user_id)
+    token = _current.set(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
+        context.flush()
+
+
+def get_user_cache():
+    """The context of the current update, or the cache outside of one"""
+    return _current.get() or cache
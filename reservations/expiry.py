@@ -0,0 +1,164 @@
+"""Policies for how long room entries are cached.
+
+EXPIRY_POLICY selects the policy:
+- ladder (default): hand-tuned thresholds on free seats and times of day
+- change-rate: learns how often the seats of an area change, per day offset and hour of day,
+  and caches for as long as a change stays unlikely
+
+Every reload of a grid tells the policy whether it changed since the previous load. With
+EXPIRY_HISTORY_FILE set, reloads are also appended to that file as JSON lines, which
+benchmarks/expiry_eval.py replays against the policies.
+"""
+import abc
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import threading
+
+EXPIRY_POLICY = os.environ.get('EXPIRY_POLICY', 'ladder')
+# Share of cache expiries at which the grid has changed meanwhile, that the change-rate policy aims for
+EXPIRY_TARGET_STALENESS = float(os.environ.get('EXPIRY_TARGET_STALENESS', 0.1))
+EXPIRY_MIN = int(os.environ.get('EXPIRY_MIN', 10))
+EXPIRY_MAX = int(os.environ.get('EXPIRY_MAX', 15 * 60))
+EXPIRY_HISTORY_FILE = os.environ.get('EXPIRY_HISTORY_FILE')
+
+_history_lock = threading.Lock()
+
+
+class ExpiryPolicy(abc.ABC):
+    @abc.abstractmethod
+    def expiry_time(self, date: datetime.datetime, area, free_seats_min: int, total_seats: int,
+                    now: datetime.datetime) -> int:
+        raise NotImplementedError
+
+    def observe(self, date: datetime.datetime, area, changed: bool, age: float, now: datetime.datetime):
+        """A grid was loaded again after `age` seconds, `changed` tells whether its seats changed."""
+        pass
+
+
+class LadderPolicy(ExpiryPolicy):
+    def expiry_time(self, date, area, free_seats_min, total_seats, now):
+        # Adaptive expiry time for quick updates at important times
+        expiry_time = 10 * 60
+        if free_seats_min == 0:
+            expiry_time = 30
+        elif free_seats_min < 5 and total_seats >= 10:
+            expiry_time = 10
+        elif free_seats_min < 10 and total_seats >= 20:
+            expiry_time = 25
+        elif free_seats_min < 15 and total_seats >= 30:
+            expiry_time = 2 * 60
+        # Times when unused bookings are freed / new day comes
+        elif date.date() == now.date() and now.hour in [23] + list(range(8, 19)):
+            minutes_to_next_half_hour = 30 - now.minute % 30
+            if minutes_to_next_half_hour == 0:
+                expiry_time = 60 - now.second
+            else:
+                expiry_time = min(5 * 60,  minutes_to_next_half_hour * 60)
+        elif date.date() - now.date() >= datetime.timedelta(days=2):
+            expiry_time = 15 * 60
+        return max(1, expiry_time + random.randrange(-5, 5))
+
+
+class ChangeRatePolicy(ExpiryPolicy):
+    """Estimates the rate of changes of an area as a Poisson process and picks the longest expiry time
+    for which a change stays below the target probability.
+
+    Statistics are kept per area, day offset (today, tomorrow, later) and hour of day in the cache, so
+    all bot instances learn together. Hours without enough observations use those of the whole day.
+    Older observations decay, so the estimate follows the semester.
+    Until a bucket has seen enough reloads, the ladder decides.
+    """
+    # Observations lose half their weight after this many seconds observed in their bucket
+    HALF_LIFE = 6 * 3600
+
+    def __init__(self, store, target: float = EXPIRY_TARGET_STALENESS, min_expiry: int = EXPIRY_MIN,
+                 max_expiry: int = EXPIRY_MAX, min_observations: int = 5, min_exposure: float = 30 * 60):
+        self.store = store
+        self.target = target
+        self.min_expiry = min_expiry
+        self.max_expiry = max_expiry
+        self.min_observations = min_observations
+        self.min_exposure = min_exposure
+        self.fallback = LadderPolicy()
+
+    def get_buckets(self, date: datetime.datetime, now: datetime.datetime) -> list[str]:
+        """The bucket of the hour, and of the whole day for hours without enough observations yet"""
+        offset = min(max((date.date() - now.date()).days, 0), 2)
+        return [f'{offset}:{now.hour}', f'{offset}:*']
+
+    def get_stats(self, area, bucket: str) -> dict:
+        data = self.store.hget(f'expiry_stats:{area}', bucket)
+        return json.loads(data) if data else {'changes': 0.0, 'exposure': 0.0, 'observations': 0}
+
+    def get_rate(self, area, bucket: str) -> float|None:
+        """Changes per second, None if there are too few observations"""
+        stats = self.get_stats(area, bucket)
+        if stats['observations'] < self.min_observations or stats['exposure'] < self.min_exposure:
+            return None
+        # Counts intervals with changes, so it underestimates the rate for intervals long enough
+        # for several changes. Expiry times chosen for a small target keep those rare.
+        return stats['changes'] / stats['exposure']
+
+    def expiry_time(self, date, area, free_seats_min, total_seats, now):
+        rate = None
+        for bucket in self.get_buckets(date, now):
+            rate = self.get_rate(area, bucket)
+            if rate is not None:
+                break
+        if rate is None:
+            return self.fallback.expiry_time(date, area, free_seats_min, total_seats, now)
+        if rate == 0:
+            expiry_time = self.max_expiry
+        else:
+            # P(change within t) = 1 - exp(-rate * t) <= target
+            expiry_time = -math.log(1 - self.target) / rate
+        expiry_time = min(self.max_expiry, max(self.min_expiry, expiry_time))
+        # Spread reloads of areas which got the same expiry time
+        return max(1, round(expiry_time * random.uniform(0.95, 1.05)))
+
+    def observe(self, date, area, changed, age, now):
+        if age <= 0:
+            return
+        decay = 0.5 ** (age / self.HALF_LIFE)
+        for bucket in self.get_buckets(date, now):
+            stats = self.get_stats(area, bucket)
+            stats = {
+                'changes': stats['changes'] * decay + (1 if changed else 0),
+                'exposure': stats['exposure'] * decay + age,
+                'observations': stats['observations'] + 1,
+            }
+            # Concurrent updates of a bucket may lose one observation, which does not matter for an estimate
+            self.store.hset(f'expiry_stats:{area}', bucket, json.dumps(stats))
+
+
+def create_expiry_policy(store) -> ExpiryPolicy:
+    if EXPIRY_POLICY == 'ladder':
+        return LadderPolicy()
+    elif EXPIRY_POLICY == 'change-rate':
+        return ChangeRatePolicy(store)
+    raise ValueError(f'Unknown EXPIRY_POLICY {EXPIRY_POLICY}, use ladder or change-rate')
+
+
+def record_refresh(date: datetime.datetime, area, content_hash: str, free_seats_min: int, total_seats: int,
+                   now: datetime.datetime, path: str = None):
+    """Append a reload to the history file, if there is one"""
+    path = path or EXPIRY_HISTORY_FILE
+    if not path:
+        return
+    line = json.dumps({
+        'time': now.timestamp(),
+        'date': date.strftime('%Y-%m-%d'),
+        'area': area,
+        'hash': content_hash,
+        'free_seats_min': free_seats_min,
+        'total_seats': total_seats,
+    })
+    try:
+        with _history_lock, open(path, 'a') as f:
+            f.write(line + '\n')
+    except OSError as e:
+        logging.warning(f'Expiry: could not record history: {e}')
@@ -0,0 +1,170 @@
+"""Export the occupancy of all areas over a range of days, as NDJSON or CSV, for capacity planning.
+
+Usage: python -m reservations.export --start 2024-05-01 [--days 31] [--format ndjson|csv] [--output FILE] [--resume]
+
+Grids are loaded concurrently through the cache, EXPORT_PREFETCH_DAYS days ahead of the day being
+written, and rows are written as soon as their day is complete. Memory stays bounded by that window,
+whatever the range. With an output file, a checkpoint next to it records the last complete day, so an
+interrupted export continues after it with --resume.
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import datetime
+import json
+import logging
+import os
+import sys
+
+from .backend import Backend
+
+EXPORT_CONCURRENCY = int(os.environ.get('EXPORT_CONCURRENCY', 8))
+# Days whose grids are loaded ahead of the one being written
+EXPORT_PREFETCH_DAYS = int(os.environ.get('EXPORT_PREFETCH_DAYS', 2))
+
+FIELDS = ['date', 'daytime', 'daytime_name', 'area', 'area_name', 'seat', 'room_id', 'state', 'cached']
+
+
+def iter_days(backend: Backend, start: datetime.date, days: int, areas: list = None,
+              concurrency: int = EXPORT_CONCURRENCY, prefetch: int = EXPORT_PREFETCH_DAYS):
+    """(date, rows) per day in order, each row a dict of FIELDS. Seats of other users are not named."""
+    areas = areas or list(backend.areas)
+    daytime_names = [daytime['name'] for daytime in backend.daytimes]
+    dates = (start + datetime.timedelta(days=i) for i in range(days))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='export') as executor:
+        window = collections.deque()
+
+        def submit_next() -> bool:
+            date = next(dates, None)
+            if date is None:
+                return False
+            day = datetime.datetime.combine(date, datetime.time())
+            window.append((date, [executor.submit(backend.get_room_entries, day, area) for area in areas]))
+            return True
+
+        for _ in range(prefetch + 1):
+            if not submit_next():
+                break
+        while window:
+            date, futures = window.popleft()
+            submit_next()
+            rows = []
+            for area, future in zip(areas, futures):
+                grid, cached = future.result()
+                for daytime, seats in grid.items():
+                    for seat in seats:
+                        rows.append({
+                            'date': date.isoformat(),
+                            'daytime': daytime,
+                            'daytime_name': daytime_names[daytime] if daytime < len(daytime_names) else None,
+                            'area': area,
+                            'area_name': backend.areas.get(area),
+                            'seat': seat.seat,
+                            'room_id': seat.room_id,
+                            'state': seat.state.name.lower(),
+                            'cached': cached,
+                        })
+            yield date, rows
+
+
+class NDJSONWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def write_header(self):
+        pass
+
+    def write_rows(self, rows: list):
+        self.out.writelines(json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+
+
+class CSVWriter:
+    def __init__(self, out):
+        self.writer = csv.DictWriter(out, FIELDS)
+
+    def write_header(self):
+        self.writer.writeheader()
+
+    def write_rows(self, rows: list):
+        self.writer.writerows(rows)
+
+
+WRITERS = {'ndjson': NDJSONWriter, 'csv': CSVWriter}
+
+
+def get_checkpoint_path(output: str) -> str:
+    return f'{output}.checkpoint'
+
+
+def read_checkpoint(output: str) -> dict|None:
+    try:
+        with open(get_checkpoint_path(output)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(output: str, date: datetime.date, offset: int):
+    path = get_checkpoint_path(output)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'date': date.isoformat(), 'offset': offset}, f)
+    os.replace(path + '.tmp', path)
+
+
+def export(backend: Backend, start: datetime.date, days: int, fmt: str = 'ndjson', output: str = None,
+           resume=False, areas: list = None) -> int:
+    """Write the occupancy of the days to output, or stdout without. Returns the number of rows written."""
+    end = start + datetime.timedelta(days=days)
+    checkpoint = read_checkpoint(output) if output and resume else None
+    if checkpoint:
+        start = datetime.date.fromisoformat(checkpoint['date']) + datetime.timedelta(days=1)
+        logging.info(f'Export: resuming at {start}')
+    if output:
+        out = open(output, 'r+' if checkpoint else 'w', newline='', encoding='UTF-8')
+        if checkpoint:
+            # Drop the rows of a day that was not completed
+            out.truncate(checkpoint['offset'])
+            out.seek(checkpoint['offset'])
+    else:
+        out = sys.stdout
+    count = 0
+    try:
+        writer = WRITERS[fmt](out)
+        if not checkpoint:
+            writer.write_header()
+        for date, rows in iter_days(backend, start, (end - start).days, areas=areas):
+            writer.write_rows(rows)
+            out.flush()
+            count += len(rows)
+            if output:
+                write_checkpoint(output, date, out.tell())
+            logging.info(f'Export: {date} done, {len(rows)} seats')
+    finally:
+        if output:
+            out.close()
+    return count
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Export the occupancy of all areas as NDJSON or CSV')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help='first day, YYYY-MM-DD (default today)')
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--format', choices=sorted(WRITERS), default='ndjson')
+    parser.add_argument('--output', help='file to write to, stdout if not given')
+    parser.add_argument('--resume', action='store_true', help='continue after the last complete day in --output')
+    parser.add_argument('--area', action='append', help='export only these areas, may be repeated')
+    args = parser.parse_args()
+    if args.resume and not args.output:
+        parser.error('--resume needs --output')
+
+    backend = Backend(os.environ.get('BASE_URL', 'https://raumbuchung.bibliothek.kit.edu/sitzplatzreservierung/'))
+    count = export(backend, args.start, args.days, fmt=args.format, output=args.output, resume=args.resume,
+                   areas=args.area)
+    logging.info(f'Export: {count} rows written')
+
+
+if __name__ == '__main__':
+    main()
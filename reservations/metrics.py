@@ -0,0 +1,83 @@
+"""Prometheus metrics for upstream requests, caches and parsing.
+
+Exposed over HTTP by start_metrics_server() if METRICS_PORT is set.
+"""
+import os
+from urllib.parse import urlparse
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+UPSTREAM_REQUESTS = Counter('reservations_upstream_requests_total',
+                            'Requests to the library server',
+                            ['endpoint', 'method', 'status'])
+UPSTREAM_LATENCY = Histogram('reservations_upstream_request_seconds',
+                             'Duration of requests to the library server',
+                             ['endpoint'], buckets=LATENCY_BUCKETS)
+UPSTREAM_BYTES = Counter('reservations_upstream_bytes_total',
+                         'Bytes received from the library server as transferred, i.e. compressed',
+                         ['endpoint'])
+UPSTREAM_RETRIES_TOTAL = Counter('reservations_upstream_retries_total',
+                                 'Requests to the library server sent again after an error',
+                                 ['endpoint'])
+UPSTREAM_HEDGES = Counter('reservations_upstream_hedges_total',
+                          'Slow requests sent a second time, winner is first or hedge',
+                          ['endpoint', 'winner'])
+CIRCUIT_OPEN = Gauge('reservations_circuit_open',
+                     'Whether requests to the library server are suspended after failures (1) or not (0)')
+CACHE_LOOKUPS = Counter('reservations_cache_lookups_total',
+                        'Cache lookups by key family, result is hit, miss or stale',
+                        ['family', 'result'])
+PARSE_DURATION = Histogram('reservations_parse_seconds',
+                           'Duration of parsing a page of the library server',
+                           ['page'], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+PARSE_SKIPS = Counter('reservations_parse_skips_total',
+                      'Pages not parsed again, reason is not_modified (HTTP 304) or same_hash (unchanged content)',
+                      ['page', 'reason'])
+EXPIRY_TIME = Histogram('reservations_room_entries_expiry_seconds',
+                        'Adaptive expiry time of cached room entries',
+                        buckets=(5, 10, 20, 30, 60, 120, 300, 600, 900, 1800))
+LOGIN_RENEWALS = Counter('reservations_login_renewals_total',
+                         'Logins at the library server',
+                         ['result'])
+BOOKING_DURATION = Histogram('reservations_booking_seconds',
+                             'Duration of booking a seat',
+                             ['result'], buckets=LATENCY_BUCKETS)
+
+PROXY_REQUESTS = Counter('reservations_proxy_requests_total',
+                         'Requests to the library server per proxy, result is ok or error (failed on the way)',
+                         ['proxy', 'result'])
+PROXY_HEALTHY = Gauge('reservations_proxy_healthy',
+                      'Whether the proxy is in the pool (1) or evicted (0)',
+                      ['proxy'])
+OUTBOX_JOBS = Counter('reservations_outbox_jobs_total',
+                      'Messages of the outbox, result is sent, coalesced, retried, flood_wait or failed',
+                      ['result'])
+OUTBOX_LATENCY = Histogram('reservations_outbox_latency_seconds',
+                           'Time messages waited in the outbox until sent',
+                           buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600))
+OUTBOX_QUEUED = Gauge('reservations_outbox_queued',
+                      'Messages waiting in the outbox')
+UPDATES_QUEUED = Counter('reservations_updates_queued_total',
+                         'Telegram updates queued by the ingress')
+UPDATES_HANDLED = Counter('reservations_updates_handled_total',
+                          'Queued updates taken by a worker, result is handled or duplicate',
+                          ['result'])
+PARTITIONS_OWNED = Gauge('reservations_partitions_owned',
+                         'Update partitions owned by the worker')
+
+
+def get_endpoint(url: str) -> str:
+    """Name of the requested page, e.g. day.php"""
+    return urlparse(url).path.rsplit('/', 1)[-1] or 'index'
+
+
+def count_cache(family: str, result: str):
+    CACHE_LOOKUPS.labels(family, result).inc()
+
+
+def start_metrics_server():
+    port = os.environ.get('METRICS_PORT')
+    if port:
+        start_http_server(int(port), addr=os.environ.get('METRICS_ADDR', '127.0.0.1'))
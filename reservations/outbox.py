@@ -0,0 +1,141 @@
+"""Queue for messages to Telegram that need not be sent right away, e.g. broadcasts to many chats.
+
+Telegram answers with 429 (RetryAfter) to bots sending more than about 30 messages per second
+overall or one per second to the same chat. The outbox spaces its sends by OUTBOX_GLOBAL_RATE and
+OUTBOX_CHAT_RATE per second, waits as long as Telegram asks after a 429 and retries. A job submitted
+with the coalesce key of a job still waiting for the same chat replaces it, so only the latest
+version of e.g. a pinned message is sent.
+
+Replies to the user's own messages are still sent directly, they come at the pace of the user.
+"""
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+
+from .metrics import OUTBOX_JOBS, OUTBOX_LATENCY, OUTBOX_QUEUED
+
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 25))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+# Attempts after network errors, waiting for a 429 does not count
+OUTBOX_ATTEMPTS = 3
+
+
+class Job:
+    __slots__ = ('chat_id', 'fn', 'enqueued', 'attempts')
+
+    def __init__(self, chat_id, fn, enqueued: float):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.enqueued = enqueued
+        self.attempts = 0
+
+
+class Outbox:
+    def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE, chat_rate: float = OUTBOX_CHAT_RATE):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        # (chat_id, coalesce key) -> Job, in the order of submission
+        self.jobs = collections.OrderedDict()
+        self.next_global = 0.0
+        self.next_chat = {}  # chat_id -> time.monotonic() of its next allowed send
+        self.unique_keys = itertools.count()
+        self.condition = threading.Condition()
+        self.sender = None
+
+    def submit(self, chat_id, fn, coalesce_key=None) -> bool:
+        """Queue fn() to be called once sending to the chat is allowed.
+
+        Returns False if it replaced a waiting job of the chat with the same coalesce key.
+        """
+        key = (chat_id, coalesce_key if coalesce_key is not None else next(self.unique_keys))
+        with self.condition:
+            waiting = self.jobs.get(key)
+            if waiting:
+                # Keeps its place in the queue and its enqueue time, only the content is newer
+                waiting.fn = fn
+                OUTBOX_JOBS.labels('coalesced').inc()
+            else:
+                self.jobs[key] = Job(chat_id, fn, time.monotonic())
+                OUTBOX_QUEUED.set(len(self.jobs))
+            if not self.sender:
+                self.sender = threading.Thread(target=self.run, name='outbox', daemon=True)
+                self.sender.start()
+            self.condition.notify()
+        return not waiting
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def next_job(self):
+        """Wait for the first job whose chat may be sent to, and for the global rate"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                ready_at = None
+                for key, job in self.jobs.items():
+                    chat_ready = self.next_chat.get(job.chat_id, 0.0)
+                    if chat_ready <= now:
+                        break
+                    ready_at = min(ready_at or chat_ready, chat_ready)
+                else:
+                    key = None
+                if key is not None and self.next_global <= now:
+                    job = self.jobs.pop(key)
+                    OUTBOX_QUEUED.set(len(self.jobs))
+                    self.next_global = now + self.global_interval
+                    self.next_chat[job.chat_id] = now + self.chat_interval
+                    if len(self.next_chat) > 10000:
+                        self.next_chat = {chat: t for chat, t in self.next_chat.items() if t > now}
+                    return key, job
+                if key is not None:
+                    ready_at = self.next_global
+                self.condition.wait(ready_at - now if ready_at else None)
+
+    def run(self):
+        from telegram.error import RetryAfter, NetworkError, TimedOut, Unauthorized, BadRequest
+        while True:
+            key, job = self.next_job()
+            try:
+                job.fn()
+            except RetryAfter as e:
+                # Flood control: hold back everything, not just this chat
+                logging.warning(f'Outbox: Telegram asked to wait {e.retry_after}s')
+                OUTBOX_JOBS.labels('flood_wait').inc()
+                self.retry(key, job, e.retry_after, pause_all=True)
+                continue
+            except (Unauthorized, BadRequest) as e:
+                # E.g. the user blocked the bot, trying again will not help
+                logging.info(f'Outbox: dropped message to {job.chat_id}: {e}')
+                OUTBOX_JOBS.labels('failed').inc()
+                continue
+            except (TimedOut, NetworkError) as e:
+                job.attempts += 1
+                if job.attempts < OUTBOX_ATTEMPTS:
+                    OUTBOX_JOBS.labels('retried').inc()
+                    self.retry(key, job, 2 ** job.attempts)
+                else:
+                    logging.warning(f'Outbox: giving up on message to {job.chat_id}: {e}')
+                    OUTBOX_JOBS.labels('failed').inc()
+                continue
+            except Exception:
+                logging.exception(f'Outbox: message to {job.chat_id} failed')
+                OUTBOX_JOBS.labels('failed').inc()
+                continue
+            OUTBOX_JOBS.labels('sent').inc()
+            OUTBOX_LATENCY.observe(time.monotonic() - job.enqueued)
+
+    def retry(self, key, job: Job, delay: float, pause_all=False):
+        with self.condition:
+            until = time.monotonic() + delay
+            self.next_chat[job.chat_id] = until
+            if pause_all:
+                self.next_global = max(self.next_global, until)
+            # A newer job with the same key submitted meanwhile supersedes this one
+            if key not in self.jobs:
+                self.jobs[key] = job
+                self.jobs.move_to_end(key, last=False)
+                OUTBOX_QUEUED.set(len(self.jobs))
+            self.condition.notify()
@@ -0,0 +1,160 @@
+"""Pool of egress proxies for the requests to the library server.
+
+PROXIES lists several proxies separated by commas or spaces, e.g. one Tor circuit each with
+socks5h://a:a@tor:9050,socks5h://b:b@tor:9050 as Tor isolates circuits by SOCKS credentials.
+Without it, PROXY makes a pool of one.
+
+A request goes to the less loaded of two random healthy proxies, weighed by their latency and error
+rate. Sessions stay on the proxy of their first request with cookies, so their cookies stay valid.
+The pin is written then and renewed only when it is about to expire, not with every request.
+Proxies failing several times in a row are evicted and probed in the background, with a growing
+pause, until they answer again.
+"""
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+from . import cache
+from .metrics import PROXY_REQUESTS, PROXY_HEALTHY
+
+# Failed requests in a row after which a proxy is evicted
+PROXY_MAX_FAILURES = int(os.environ.get('PROXY_MAX_FAILURES', 3))
+# Seconds until an evicted proxy is probed, doubled after every failed probe up to PROXY_EVICT_MAX
+PROXY_EVICT_TIME = int(os.environ.get('PROXY_EVICT_TIME', 30))
+PROXY_EVICT_MAX = int(os.environ.get('PROXY_EVICT_MAX', 10 * 60))
+PROXY_PIN_EXPIRY = 24 * 3600
+# Seconds before its expiry in which a pin is renewed by the next request of its session
+PROXY_PIN_RENEW = 6 * 3600
+# Weight of the latest request in the moving averages of latency and errors
+SMOOTHING = 0.2
+
+
+class ProxyState:
+    __slots__ = ('url', 'name', 'latency', 'error_rate', 'failures', 'in_flight', 'evicted_until', 'backoff')
+
+    def __init__(self, url: str, index: int):
+        self.url = url
+        parsed = urlparse(url)
+        # Without the credentials, but several proxies may share a host
+        self.name = f'{index}:{parsed.hostname}:{parsed.port}'
+        self.latency = 1.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.in_flight = 0
+        self.evicted_until = None
+        self.backoff = PROXY_EVICT_TIME
+
+    @property
+    def score(self) -> float:
+        return self.latency * (1 + self.in_flight) / (1 - min(self.error_rate, 0.9))
+
+
+class ProxyPool:
+    def __init__(self, urls: list[str], probe):
+        """probe(proxy) -> bool tells whether an evicted proxy works again"""
+        self.proxies = {url: ProxyState(url, i) for i, url in enumerate(urls)}
+        self.probe = probe
+        self.lock = threading.Lock()
+        self.checker = None
+        for state in self.proxies.values():
+            PROXY_HEALTHY.labels(state.name).set(1)
+
+    def choose(self, cookies=None) -> tuple[str, str|None]:
+        """The proxy for a request and the key its session is pinned by, if it has cookies"""
+        pin_key = get_pin_key(cookies)
+        pinned, expires = parse_pin(cache.get(pin_key)) if pin_key else (None, None)
+        with self.lock:
+            state = self.proxies.get(pinned) if pinned else None
+            if not state or state.evicted_until is not None:
+                healthy = [s for s in self.proxies.values() if s.evicted_until is None]
+                if not healthy:
+                    # Better to try one than to fail every request
+                    healthy = [min(self.proxies.values(), key=lambda s: s.evicted_until)]
+                state = min(random.sample(healthy, min(2, len(healthy))), key=lambda s: s.score)
+            state.in_flight += 1
+        renew = expires is None or expires - time.time() < PROXY_PIN_RENEW
+        return state.url, pin_key if pinned == state.url and not renew else None
+
+    def release(self, proxy: str, latency: float, ok: bool):
+        """Record the outcome of a request, ok is False if it failed on the way, e.g. timed out"""
+        with self.lock:
+            state = self.proxies[proxy]
+            state.in_flight -= 1
+            state.error_rate += SMOOTHING * ((0.0 if ok else 1.0) - state.error_rate)
+            if ok:
+                state.latency += SMOOTHING * (latency - state.latency)
+                state.failures = 0
+            else:
+                state.failures += 1
+                if state.failures >= PROXY_MAX_FAILURES and state.evicted_until is None:
+                    self.evict(state)
+        PROXY_REQUESTS.labels(state.name, 'ok' if ok else 'error').inc()
+
+    def pin(self, cookies, proxy: str, pinned_key: str|None):
+        """Keep the session of the cookies on the proxy, unless they are pinned already and not about to expire"""
+        pin_key = get_pin_key(cookies)
+        if pin_key and pin_key != pinned_key:
+            cache.set(pin_key, f'{int(time.time()) + PROXY_PIN_EXPIRY} {proxy}', ex=PROXY_PIN_EXPIRY)
+
+    def evict(self, state: ProxyState):
+        logging.warning(f'Proxy {state.name} evicted after {state.failures} failures, probing in {state.backoff}s')
+        state.evicted_until = time.monotonic() + state.backoff
+        PROXY_HEALTHY.labels(state.name).set(0)
+        if not self.checker:
+            self.checker = threading.Thread(target=self.check_evicted, name='proxy-checker', daemon=True)
+            self.checker.start()
+
+    def check_evicted(self):
+        """Probe evicted proxies when their pause is over and admit them again if they answer"""
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            with self.lock:
+                due = [s for s in self.proxies.values() if s.evicted_until is not None and s.evicted_until <= now]
+            for state in due:
+                try:
+                    ok = self.probe(state.url)
+                except Exception:
+                    ok = False
+                with self.lock:
+                    if ok:
+                        logging.info(f'Proxy {state.name} admitted again')
+                        state.evicted_until = None
+                        state.failures = 0
+                        state.error_rate = 0.0
+                        state.backoff = PROXY_EVICT_TIME
+                        PROXY_HEALTHY.labels(state.name).set(1)
+                    else:
+                        state.backoff = min(2 * state.backoff, PROXY_EVICT_MAX)
+                        state.evicted_until = time.monotonic() + state.backoff
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {s.name: {'latency_ms': round(s.latency * 1000, 1), 'error_rate': round(s.error_rate, 3),
+                             'in_flight': s.in_flight, 'healthy': s.evicted_until is None}
+                    for s in self.proxies.values()}
+
+
+def get_proxy_urls() -> list[str]:
+    proxies = os.environ.get('PROXIES') or os.environ.get('PROXY') or ''
+    return [p for p in re.split(r'[\s,]+', proxies) if p]
+
+
+def parse_pin(value: bytes|None) -> tuple[str|None, int|None]:
+    """The proxy and expiry time of a pin, pins without one count as expiring"""
+    if not value:
+        return None, None
+    expires, _, proxy = value.decode().rpartition(' ')
+    return proxy, int(expires) if expires else None
+
+
+def get_pin_key(cookies) -> str|None:
+    if not cookies:
+        return None
+    session = ';'.join(sorted(f'{c.name}={c.value}' for c in cookies))
+    return f'proxy_pin:{hashlib.blake2b(session.encode(), digest_size=16).hexdigest()}'
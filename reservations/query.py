@@ -1,8 +1,10 @@
 import datetime
-from itertools import groupby
 
 from reservations.backend import State
 
+# Counter of an aggregate per state, seats of unknown state only count to the total
+STATE_COUNTERS = {State.FREE: 'free', State.OCCUPIED: 'occupied', State.MINE: 'mine'}
+
 
 def get_own_bookings(backend, cookies):
     start_day = datetime.datetime.today()
@@ -10,20 +12,42 @@ def get_own_bookings(backend, cookies):
     return bookings
 
 
+def aggregate_bookings(bookings, areas=None, daytimes=None, keep_seats=True, results=None) -> dict:
+    """daytime -> area -> {'free', 'occupied', 'mine', 'total', 'seats'} in one pass over the bookings.
+
+    The bookings may come in any order and from any iterable, e.g. straight from backend.iter_bookings.
+    Areas are named by the areas dict if given. Daytimes limits the result to these, which are listed
+    even without bookings. Passing the result of an earlier call as results adds the bookings to it.
+    """
+    if results is None:
+        results = {daytime: {} for daytime in daytimes or []}
+    wanted = set(daytimes) if daytimes is not None else None
+    for booking in bookings:
+        daytime = booking['daytime']
+        if wanted is not None and daytime not in wanted:
+            continue
+        area = areas[booking['room']] if areas else booking['room']
+        area_results = results.setdefault(daytime, {})
+        counts = area_results.get(area)
+        if counts is None:
+            counts = area_results[area] = {'free': 0, 'occupied': 0, 'mine': 0, 'total': 0, 'seats': []}
+        counter = STATE_COUNTERS.get(booking['state'])
+        if counter:
+            counts[counter] += 1
+        counts['total'] += 1
+        if keep_seats:
+            counts['seats'].append(booking)
+    return results
+
+
 def group_bookings(backend, bookings, areas, daytimes=None):
-    results = {}
+    """daytime -> area name -> its bookings"""
     # if isinstance(daytimes, Daytime):
     #     daytimes = [daytimes]
     # elif daytimes is None:
     #     daytimes = [Daytime.MORNING, Daytime.AFTERNOON, Daytime.EVENING]
     if daytimes is None:
         daytimes = [d['index'] for d in backend.daytimes]
-    for daytime in daytimes:
-        cur_bookings = filter(lambda b: b['daytime'] == daytime, bookings)
-        room_groups = groupby(cur_bookings, key=lambda b: b['room'])
-        room_bookings = {
-            areas[room]: list(bookings) for room, bookings in room_groups
-        }
-        results[daytime] = room_bookings
-    return results
-
+    aggregated = aggregate_bookings(bookings, areas, daytimes)
+    return {daytime: {area: counts['seats'] for area, counts in rooms.items()}
+            for daytime, rooms in aggregated.items()}
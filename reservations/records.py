@@ -0,0 +1,168 @@
+"""Compact records for seats, grids and bookings.
+
+A full sweep holds tens of thousands of seats, so they are named tuples instead of dicts. Reading
+fields like keys, e.g. seat['state'] or booking['seat']['room_id'], keeps working.
+"""
+import datetime
+import sys
+from enum import IntEnum
+from typing import NamedTuple
+
+
+class State(IntEnum):
+    FREE = 1
+    OCCUPIED = 2
+    MINE = 3
+    UNKNOWN = 4
+
+
+def _getitem(self, key):
+    if isinstance(key, str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    return tuple.__getitem__(self, key)
+
+
+def _get(self, key, default=None):
+    return getattr(self, key, default)
+
+
+class Seat(NamedTuple):
+    area: str
+    seat: str
+    room_id: str
+    state: State
+    occupier: str|None
+    entry_id: str|None
+
+    __getitem__ = _getitem
+    get = _get
+
+    @classmethod
+    def from_json(cls, data) -> 'Seat':
+        """From the list stored in the cache, or the dict of older cache entries."""
+        if isinstance(data, dict):
+            data = (data['area'], data['seat'], data['room_id'], data['state'], data['occupier'], data['entry_id'])
+        area, seat, room_id, state, occupier, entry_id = data
+        # The same labels repeat in every grid of every day, share them instead of keeping copies
+        return cls(sys.intern(str(area)), sys.intern(seat), sys.intern(room_id), State(state),
+                   sys.intern(occupier) if occupier else None, entry_id)
+
+    def to_dict(self) -> dict:
+        return self._asdict()
+
+
+class Grid(tuple):
+    """Seats of an area on one day, one row of seats per daytime index."""
+    __slots__ = ()
+
+    def items(self):
+        return enumerate(self)
+
+    @classmethod
+    def from_rows(cls, rows) -> 'Grid':
+        return cls(tuple(row) for row in rows)
+
+    @classmethod
+    def from_json(cls, data) -> 'Grid':
+        """From the nested lists stored in the cache, or the dict by daytime of older cache entries."""
+        if isinstance(data, dict):
+            data = [data[daytime] for daytime in sorted(data, key=int)]
+        return cls(tuple(Seat.from_json(seat) for seat in row) for row in data)
+
+
+class Booking(NamedTuple):
+    date: datetime.datetime
+    daytime: int
+    seat: Seat
+    room: str
+    cached: bool
+
+    __getitem__ = _getitem
+    get = _get
+
+    @property
+    def state(self) -> State:
+        return self.seat.state
+
+    @property
+    def area(self) -> str:
+        return self.seat.area
+
+    def to_dict(self) -> dict:
+        return {
+            'date': self.date,
+            'daytime': self.daytime,
+            'seat': self.seat.to_dict(),
+            'state': self.state,
+            'room': self.room,
+            'area': self.area,
+            'cached': self.cached,
+        }
+
+
+class SeatIndex(NamedTuple):
+    """Free and occupied seats of a grid as bitmaps per daytime, bit i standing for column i.
+
+    Answers how many and which seats are free without going through the seat records.
+    """
+    labels: tuple  # (seat, room_id) per column
+    free: tuple  # bitmap per daytime
+    occupied: tuple  # bitmap per daytime
+    totals: tuple  # seats per daytime
+
+    @classmethod
+    def from_grid(cls, grid: Grid) -> 'SeatIndex':
+        columns = max(grid, key=len, default=())
+        labels = tuple((seat.seat, seat.room_id) for seat in columns)
+        free, occupied = [], []
+        for row in grid:
+            free_bits = occupied_bits = 0
+            for i, seat in enumerate(row):
+                if seat.state == State.FREE:
+                    free_bits |= 1 << i
+                elif seat.state == State.OCCUPIED:
+                    occupied_bits |= 1 << i
+            free.append(free_bits)
+            occupied.append(occupied_bits)
+        return cls(labels, tuple(free), tuple(occupied), tuple(len(row) for row in grid))
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'SeatIndex':
+        return cls(tuple((sys.intern(seat), sys.intern(room_id)) for seat, room_id in data['labels']),
+                   tuple(data['free']), tuple(data['occupied']), tuple(data['totals']))
+
+    def to_json(self) -> dict:
+        return {'labels': self.labels, 'free': self.free, 'occupied': self.occupied, 'totals': self.totals}
+
+    def has_daytime(self, daytime: int) -> bool:
+        return 0 <= daytime < len(self.totals)
+
+    def free_count(self, daytime: int) -> int:
+        return self.free[daytime].bit_count()
+
+    def occupied_count(self, daytime: int) -> int:
+        return self.occupied[daytime].bit_count()
+
+    def total(self, daytime: int) -> int:
+        return self.totals[daytime]
+
+    def free_seats(self, daytime: int, limit: int = None) -> list[tuple[str, str]]:
+        """(seat, room_id) of the free seats in column order."""
+        seats = []
+        bits = self.free[daytime]
+        while bits and (limit is None or len(seats) < limit):
+            lowest = bits & -bits
+            seats.append(self.labels[lowest.bit_length() - 1])
+            bits ^= lowest
+        return seats
+
+
+class SummaryEntry(NamedTuple):
+    """Free seats of an area at one daytime, as shown in the overview."""
+    free: int
+    total: int
+    seats: list  # (seat, room_id) of the first free seats
+    cached: bool
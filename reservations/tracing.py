@@ -0,0 +1,179 @@
+"""Lightweight tracing of a request through handler, cache, upstream and parsing.
+
+A trace is started with trace() for each update, nested work is wrapped in span() or @traced.
+Outside of a trace span() does nothing, so the backend can be used without tracing.
+
+Configuration:
+- TRACE_SAMPLE_RATE: share of traces exported, between 0 and 1 (default 0)
+- TRACE_FILE: append exported traces as JSON lines to this file
+- TRACE_COLLECTOR_URL: POST exported traces as JSON to this URL
+- TRACE_SLOW_THRESHOLD: log the span tree of every trace taking longer than this many seconds
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+TRACE_FILE = os.environ.get('TRACE_FILE')
+TRACE_COLLECTOR_URL = os.environ.get('TRACE_COLLECTOR_URL')
+TRACE_SLOW_THRESHOLD = float(os.environ.get('TRACE_SLOW_THRESHOLD', 0))
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_export_queue = queue.Queue(maxsize=1000)
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent', 'start', 'wall_start', 'duration', 'attributes',
+                 'children', 'error')
+
+    def __init__(self, name: str, trace_id: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.duration = None
+        self.attributes = attributes or {}
+        self.children = []
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'start': self.wall_start,
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            'attributes': self.attributes,
+            'error': self.error,
+            'children': [child.to_dict() for child in list(self.children)],
+        }
+
+    def format_tree(self, depth=0) -> str:
+        duration = f'{self.duration * 1000:.1f}ms' if self.duration is not None else 'unfinished'
+        attributes = ' '.join(f'{k}={v}' for k, v in self.attributes.items())
+        line = f"{'  ' * depth}{self.name} {duration} {attributes}".rstrip()
+        if self.error:
+            line += f' error={self.error}'
+        return '\n'.join([line] + [child.format_tree(depth + 1) for child in list(self.children)])
+
+
+def current_span() -> Span|None:
+    return _current_span.get()
+
+
+def current_trace_id() -> str|None:
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a unit of work as child of the current span, a no-op outside of a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent, attributes)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        child.finish()
+        _current_span.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Start a new trace, or a span if there is already one running."""
+    if _current_span.get() is not None:
+        with span(name, **attributes) as s:
+            yield s
+        return
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled and not TRACE_SLOW_THRESHOLD:
+        yield None
+        return
+
+    root = Span(name, uuid.uuid4().hex, attributes=attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.finish()
+        _current_span.reset(token)
+        if TRACE_SLOW_THRESHOLD and root.duration > TRACE_SLOW_THRESHOLD:
+            logging.warning(f'Slow request {root.trace_id} took {root.duration:.2f}s:\n{root.format_tree()}')
+        if sampled:
+            export(root)
+
+
+def traced(name: str = None):
+    """Decorator running the function in a span."""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def export(root: Span):
+    if not TRACE_FILE and not TRACE_COLLECTOR_URL:
+        return
+    _start_exporter()
+    try:
+        _export_queue.put_nowait(root.to_dict())
+    except queue.Full:
+        logging.warning('Tracing: export queue is full, dropping trace')
+
+
+def _start_exporter():
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = threading.Thread(target=_run_exporter, name='trace-exporter', daemon=True)
+            _exporter.start()
+
+
+def _run_exporter():
+    while True:
+        data = _export_queue.get()
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, 'a') as f:
+                    f.write(json.dumps(data) + '\n')
+            if TRACE_COLLECTOR_URL:
+                requests.post(TRACE_COLLECTOR_URL, json=data, timeout=5)
+        except Exception as e:
+            logging.warning(f'Tracing: exporting trace {data["trace_id"]} failed: {e}')
@@ -0,0 +1,132 @@
+"""Deadlines, retries, hedging and a circuit breaker for the requests to the library server.
+
+- Every request gets a connect and read timeout, per endpoint from UPSTREAM_TIMEOUTS,
+  e.g. "day.php=3:8,report.php=5:20", otherwise UPSTREAM_CONNECT_TIMEOUT and UPSTREAM_READ_TIMEOUT.
+- GETs of pages that change nothing are retried up to UPSTREAM_RETRIES times on connection errors,
+  timeouts and 502/503/504, after a random pause of up to UPSTREAM_BACKOFF * 2^attempt seconds.
+- A day.php request not answered within the UPSTREAM_HEDGE_PERCENTILE of recent latencies is sent a
+  second time, the first answer wins.
+- After CIRCUIT_FAILURES failed requests in a row the circuit opens: requests fail right away with
+  UpstreamUnavailable for CIRCUIT_OPEN_TIME seconds, then a single request probes the server again.
+  Meanwhile the backend answers from the cache only.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from .metrics import CIRCUIT_OPEN
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 20))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.2))
+UPSTREAM_HEDGE_PERCENTILE = float(os.environ.get('UPSTREAM_HEDGE_PERCENTILE', 0.95))
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', 5))
+CIRCUIT_OPEN_TIME = float(os.environ.get('CIRCUIT_OPEN_TIME', 30))
+
+# Deleting an entry is a GET as well, it must not be sent twice
+NON_IDEMPOTENT_ENDPOINTS = {'del_entry.php'}
+HEDGED_ENDPOINTS = {'day.php'}
+# Latencies needed before hedging, and the shortest delay of a hedge
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+RETRY_STATUS = {502, 503, 504}
+# Results of CircuitBreaker.allow() letting a request through
+CLOSED, PROBE = 'closed', 'probe'
+
+
+class UpstreamUnavailable(Exception):
+    def __init__(self):
+        super().__init__('Die Bibliothek ist gerade nicht erreichbar, bitte versuche es später noch einmal.')
+
+
+def parse_timeouts(value: str) -> dict:
+    """endpoint -> (connect, read) from "day.php=3:8,report.php=5:20" """
+    timeouts = {}
+    for item in value.replace(' ', '').split(','):
+        if '=' in item:
+            endpoint, timeout = item.split('=', 1)
+            connect, _, read = timeout.partition(':')
+            timeouts[endpoint] = (float(connect), float(read or connect))
+    return timeouts
+
+
+UPSTREAM_TIMEOUTS = parse_timeouts(os.environ.get('UPSTREAM_TIMEOUTS', 'day.php=5:10'))
+
+
+def get_timeout(endpoint: str) -> tuple[float, float]:
+    return UPSTREAM_TIMEOUTS.get(endpoint, (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+
+
+def is_idempotent(method: str, endpoint: str) -> bool:
+    return method == 'GET' and endpoint not in NON_IDEMPOTENT_ENDPOINTS
+
+
+class LatencyTracker:
+    """Recent latencies per endpoint, to derive when a request is slow enough to hedge."""
+
+    def __init__(self, window: int = 200):
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, latency: float):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+
+    def hedge_delay(self, endpoint: str) -> float|None:
+        """Seconds after which to hedge a request, None without enough samples"""
+        with self.lock:
+            latencies = sorted(self.latencies[endpoint])
+        if endpoint not in HEDGED_ENDPOINTS or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, latencies[int(min(UPSTREAM_HEDGE_PERCENTILE, 1) * (len(latencies) - 1))])
+
+
+class CircuitBreaker:
+    """Closed while requests succeed, open after failures in a row, half open to probe after a pause."""
+
+    def __init__(self, failures: int = CIRCUIT_FAILURES, open_time: float = CIRCUIT_OPEN_TIME):
+        self.max_failures = failures
+        self.open_time = open_time
+        self.failures = 0
+        self.opened = None  # time.monotonic() when the circuit opened
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened is not None
+
+    def allow(self) -> str|None:
+        """None if the request must not be sent, PROBE if it is the one probing the server, CLOSED otherwise"""
+        with self.lock:
+            if self.opened is None:
+                return CLOSED
+            if not self.probing and time.monotonic() - self.opened >= self.open_time:
+                # Let one request through to find out whether the server is back
+                self.probing = True
+                return PROBE
+            return None
+
+    def record(self, ok: bool, probe=False):
+        """The result of a request, probe tells whether it was let through as PROBE"""
+        with self.lock:
+            if probe:
+                self.probing = False
+            if ok:
+                if self.opened is not None:
+                    logging.info('Upstream: library server reachable again, closing the circuit')
+                    CIRCUIT_OPEN.set(0)
+                self.failures = 0
+                self.opened = None
+                self.probing = False
+            else:
+                self.failures += 1
+                # Late results of requests sent before the circuit opened do not decide about the probe
+                if (probe and self.opened is not None) or (self.opened is None and self.failures >= self.max_failures):
+                    logging.warning(f'Upstream: {self.failures} failed requests, answering from the cache '
+                                    f'for {self.open_time:.0f} seconds')
+                    self.opened = time.monotonic()
+                    CIRCUIT_OPEN.set(1)
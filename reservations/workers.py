@@ -0,0 +1,282 @@
+"""Scale-out of the bot: an ingress polls Telegram and queues the updates in redis, any number of workers handle them.
+
+Updates are split by chat into UPDATE_PARTITIONS redis streams. Each partition is owned by one worker
+at a time through a lease, and its owner handles the updates one after the other, so the updates of a
+chat keep their order. Workers share the partitions evenly, hand some over when another worker joins
+and take over those whose owner stopped renewing its lease.
+
+A new owner first handles the entries the previous owner read but did not acknowledge. Updates whose
+handling had already started are skipped, so a booking is never submitted twice.
+
+Jobs that should run once across all workers, e.g. refreshing the metadata, run under a leader lease,
+see run_as_leader.
+"""
+import json
+import logging
+import math
+import os
+import signal
+import socket
+import threading
+import time
+import zlib
+from collections.abc import MutableMapping
+
+from . import cache
+from .cache import RedisCache
+from .metrics import UPDATES_QUEUED, UPDATES_HANDLED, PARTITIONS_OWNED
+
+UPDATE_PARTITIONS = int(os.environ.get('UPDATE_PARTITIONS', 16))
+# Seconds a worker keeps its partitions without renewing, i.e. until others take over after it died
+UPDATE_LEASE_TIME = int(os.environ.get('UPDATE_LEASE_TIME', 30))
+UPDATE_STREAM_MAXLEN = int(os.environ.get('UPDATE_STREAM_MAXLEN', 10000))
+POLL_TIMEOUT = 30
+
+GROUP = 'workers'
+# All owners of a partition read as the same consumer, so a new owner finds the pending entries of the previous one
+CONSUMER = 'owner'
+
+
+def get_redis():
+    if not isinstance(cache, RedisCache):
+        raise RuntimeError('The ingress and workers share the updates through redis, set CACHE_BACKEND=redis')
+    return cache.client
+
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def get_partition_key(partition: int) -> str:
+    return f'updates:{partition}'
+
+
+def get_partition(update) -> int:
+    """Partition of an update, by chat, or by user for updates without a chat"""
+    chat = update.effective_chat or update.effective_user
+    return zlib.crc32(str(chat.id if chat else 0).encode()) % UPDATE_PARTITIONS
+
+
+def install_stop_handler() -> threading.Event:
+    """Event set on SIGTERM or SIGINT, e.g. when docker stops the container"""
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    return stop
+
+
+class Lease:
+    """A key in redis held by one owner, which has to renew it before it expires."""
+
+    def __init__(self, client, key: str, owner: str, ttl: float):
+        self.client = client
+        self.key = key
+        self.owner = owner.encode()
+        self.ttl_ms = int(ttl * 1000)
+
+    def acquire(self) -> bool:
+        return bool(self.client.set(self.key, self.owner, nx=True, px=self.ttl_ms)) or self.renew()
+
+    def renew(self) -> bool:
+        def renew_if_owner(pipe):
+            if pipe.get(self.key) != self.owner:
+                return False
+            pipe.multi()
+            pipe.pexpire(self.key, self.ttl_ms)
+            return True
+        return self.client.transaction(renew_if_owner, self.key, value_from_callable=True)
+
+    def release(self):
+        def delete_if_owner(pipe):
+            if pipe.get(self.key) == self.owner:
+                pipe.multi()
+                pipe.delete(self.key)
+        self.client.transaction(delete_if_owner, self.key)
+
+
+class SharedConversations(MutableMapping):
+    """States of a ConversationHandler in redis, so any worker can continue a conversation."""
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.key = f'conversations:{name}'
+
+    def __getitem__(self, key):
+        value = self.client.hget(self.key, json.dumps(key))
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+    def __setitem__(self, key, value):
+        self.client.hset(self.key, json.dumps(key), json.dumps(value))
+
+    def __delitem__(self, key):
+        if not self.client.hdel(self.key, json.dumps(key)):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return (tuple(json.loads(key)) for key in self.client.hkeys(self.key))
+
+    def __len__(self):
+        return self.client.hlen(self.key)
+
+
+def share_conversations(dispatcher):
+    """Keep the states of all ConversationHandlers of the dispatcher in redis, they need a name."""
+    from telegram.ext import ConversationHandler
+    client = get_redis()
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                if not handler.name:
+                    raise ValueError('Shared conversations need a name')
+                handler.conversations = SharedConversations(client, handler.name)
+
+
+def run_ingress(bot, stop: threading.Event):
+    """Poll Telegram for updates and queue them in the partition of their chat."""
+    from telegram.error import TelegramError
+    client = get_redis()
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+        except TelegramError as e:
+            logging.warning(f'Ingress: polling failed: {e}')
+            stop.wait(1)
+            continue
+        if not updates:
+            continue
+        pipe = client.pipeline(transaction=False)
+        for update in updates:
+            pipe.xadd(get_partition_key(get_partition(update)), {'update': update.to_json()},
+                      maxlen=UPDATE_STREAM_MAXLEN, approximate=True)
+        pipe.execute()
+        UPDATES_QUEUED.inc(len(updates))
+        # Confirms the updates to Telegram with the next poll. If the ingress dies before, they are
+        # queued again and the workers skip them.
+        offset = updates[-1].update_id + 1
+
+
+class Worker:
+    """Handles the updates of the partitions it owns with the dispatcher."""
+
+    def __init__(self, dispatcher, stop: threading.Event):
+        self.dispatcher = dispatcher
+        self.stop = stop
+        self.client = get_redis()
+        self.id = get_worker_id()
+        self.leases = {}  # partition -> Lease
+        self.lock = threading.Lock()
+
+    def run(self):
+        from redis.exceptions import ResponseError
+        for partition in range(UPDATE_PARTITIONS):
+            try:
+                self.client.xgroup_create(get_partition_key(partition), GROUP, id='0', mkstream=True)
+            except ResponseError as e:
+                # Created by another worker before
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        threading.Thread(target=self.renew_leases, name='renew-leases', daemon=True).start()
+        logging.info(f'Worker {self.id} started')
+        try:
+            while not self.stop.is_set():
+                self.balance()
+                with self.lock:
+                    streams = {get_partition_key(partition): '>' for partition in self.leases}
+                if not streams:
+                    self.stop.wait(1)
+                    continue
+                entries = self.client.xreadgroup(GROUP, CONSUMER, streams, count=10, block=1000)
+                self.handle_entries(entries)
+        finally:
+            with self.lock:
+                for lease in self.leases.values():
+                    lease.release()
+                self.leases.clear()
+            self.client.zrem('workers', self.id)
+
+    def balance(self):
+        """Take free partitions up to an even share, and hand over those above it.
+
+        Runs between updates only, a partition is never handed over while one of its updates is handled.
+        """
+        now = time.time()
+        self.client.zadd('workers', {self.id: now})
+        self.client.zremrangebyscore('workers', 0, now - UPDATE_LEASE_TIME)
+        share = math.ceil(UPDATE_PARTITIONS / max(1, self.client.zcard('workers')))
+        with self.lock:
+            while len(self.leases) > share:
+                partition, lease = self.leases.popitem()
+                lease.release()
+                logging.info(f'Worker {self.id} handed over partition {partition}')
+            acquired = []
+            # Start at a different partition on every worker, so they do not compete for the same ones
+            start = zlib.crc32(self.id.encode())
+            for i in range(UPDATE_PARTITIONS):
+                if len(self.leases) >= share:
+                    break
+                partition = (start + i) % UPDATE_PARTITIONS
+                if partition in self.leases:
+                    continue
+                lease = Lease(self.client, f'updates_lease:{partition}', self.id, UPDATE_LEASE_TIME)
+                if lease.acquire():
+                    self.leases[partition] = lease
+                    acquired.append(partition)
+            PARTITIONS_OWNED.set(len(self.leases))
+        for partition in acquired:
+            # Entries the previous owner read but did not acknowledge
+            entries = self.client.xreadgroup(GROUP, CONSUMER, {get_partition_key(partition): '0'})
+            self.handle_entries(entries)
+
+    def renew_leases(self):
+        """Renews the leases in the background, also while a slow update is handled"""
+        while not self.stop.wait(UPDATE_LEASE_TIME / 3):
+            self.client.zadd('workers', {self.id: time.time()})
+            with self.lock:
+                for partition, lease in list(self.leases.items()):
+                    if not lease.renew():
+                        del self.leases[partition]
+                        logging.warning(f'Worker {self.id} lost partition {partition}')
+
+    def handle_entries(self, entries):
+        for stream, messages in entries or []:
+            partition = int(stream.decode().rsplit(':', 1)[1])
+            for entry_id, fields in messages:
+                if partition not in self.leases:
+                    # Lost meanwhile, the new owner handles the remaining entries
+                    break
+                self.handle(fields)
+                self.client.xack(stream, GROUP, entry_id)
+
+    def handle(self, fields: dict):
+        from telegram import Update
+        data = json.loads(fields[b'update'])
+        if not self.client.set(f'update_started:{data["update_id"]}', self.id, nx=True, ex=24 * 3600):
+            UPDATES_HANDLED.labels('duplicate').inc()
+            return
+        self.dispatcher.process_update(Update.de_json(data, self.dispatcher.bot))
+        UPDATES_HANDLED.labels('handled').inc()
+
+
+def run_as_leader(name: str, job, interval: float, stop: threading.Event):
+    """Run job every interval seconds, in only one of all processes calling this with the same name.
+
+    The other processes wait and take over if the leader stops. Jobs should take less than twice
+    UPDATE_LEASE_TIME, otherwise the lease may expire while the job runs.
+    """
+    client = get_redis()
+    lease = Lease(client, f'leader:{name}', get_worker_id(), 2 * UPDATE_LEASE_TIME)
+    last_run_key = f'leader:{name}:last_run'
+    while not stop.is_set():
+        if lease.acquire():
+            last_run = client.get(last_run_key)
+            if not last_run or time.time() - float(last_run) >= interval:
+                try:
+                    job()
+                except Exception:
+                    logging.exception(f'Leader job {name} failed')
+                client.set(last_run_key, time.time())
+        stop.wait(UPDATE_LEASE_TIME / 3)
+    lease.release()
@@ -1,40 +1,47 @@
+import time
+
+START_TIME = time.perf_counter()
+
 import datetime
+import functools
+import json
 import locale
 import math
 import os
 import logging
 import pickle
 import re
+import threading
 import traceback
 
-from telegram.ext import Updater, ConversationHandler, CallbackContext
-from telegram.ext import CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, Dispatcher, ConversationHandler, CallbackContext, ExtBot
+from telegram.ext import CommandHandler, MessageHandler, Filters, MessageFilter
 from telegram import ReplyKeyboardMarkup, Update, ParseMode, ChatAction
+from telegram.utils.request import Request
 
-from reservations import redis
-from reservations.backend import Backend, State, get_user_creds, remove_user_creds
-from reservations.query import group_bookings
+from reservations import cache
+from reservations.backend import Backend, State, get_user_creds, remove_user_creds, get_room_entries_version
+from reservations.context import user_context, get_user_cache
+from reservations.upstream import UpstreamUnavailable
+from reservations.metrics import count_cache, start_metrics_server
+from reservations.outbox import Outbox
+from reservations.tracing import trace, traced, span
+from reservations.workers import Worker, run_ingress, run_as_leader, share_conversations, install_stop_handler
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
-locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
+try:
+    locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
+except locale.Error:
+    logging.warning('Locale de_DE.UTF-8 is not available, dates are formatted in the default locale')
 DATE_FORMAT = "%a, %d.%m."
 
-request_kwargs = None
-proxy = os.environ.get('PROXY')
-if proxy:
-    request_kwargs = {
-        'proxy_url': proxy
-    }
-updater = Updater(token=os.environ.get('BOT_TOKEN'), request_kwargs=request_kwargs)
-dispatcher = updater.dispatcher
-
 server_notice = os.environ.get('SERVER_NOTICE')
 
 captcha_enabled = os.environ.get('CAPTCHA_ENABLED', '').lower() == 'true'
 
-base_url = 'https://raumbuchung.bibliothek.kit.edu/sitzplatzreservierung/'
+base_url = os.environ.get('BASE_URL', 'https://raumbuchung.bibliothek.kit.edu/sitzplatzreservierung/')
 
 b = Backend(base_url)
 
@@ -44,22 +51,38 @@ LOGIN_MARKUP = ['Login']
 EXTRA_MARKUP = ['Zeiten', 'Statistiken', 'Ausloggen']
 CANCEL_MARKUP = ['Abbrechen']
 NEW_LOGIN_MARKUP = ['Neu einloggen']
-DAYTIME_MARKUP = [daytime['name'].title() for daytime in b.daytimes]
 
 USERNAME, PASSWORD, CAPTCHA, RESERVATIONS, BOOK = range(5)
 TIME, DAY = range(2)
 
+# Upper bound for rendered messages, they are invalidated anyway when the grids change
+RENDER_EXPIRY = int(os.environ.get('RENDER_EXPIRY', 15 * 60))
+# all: poll and handle updates in this process, ingress: poll and queue them, worker: handle queued updates
+BOT_ROLE = os.environ.get('BOT_ROLE', 'all')
+# Areas and daytimes are cached for a day, workers refresh them before
+METADATA_REFRESH_INTERVAL = int(os.environ.get('METADATA_REFRESH_INTERVAL', 12 * 3600))
+# Chats allowed to send /broadcast, separated by commas
+ADMIN_CHAT_IDS = {int(c) for c in re.split(r'[\s,]+', os.environ.get('ADMIN_CHAT_IDS', '')) if c}
+
+# Messages that may wait, sent within the rate limits of Telegram
+outbox = Outbox()
+
 
 def clear_state(update: Update):
-    #redis.delete(get_user_key(update, 'day_selected'))
-    redis.delete(get_user_key(update, 'login_username'))
-    redis.delete(get_user_key(update, 'login_password'))
-    redis.delete(get_user_key(update, 'login_cookies'))
+    #cache.delete(get_user_key(update, 'day_selected'))
+    get_user_cache().delete(get_user_key(update, 'login_username'),
+                            get_user_key(update, 'login_password'),
+                            get_user_key(update, 'login_cookies'))
 
 
+@traced('check_login')
 def check_login(update: Update, login_required=False):
     user_id = update.message.from_user.id
-    cookies = b.login(user_id, login_required=login_required)
+    try:
+        cookies = b.login(user_id, login_required=login_required)
+    except UpstreamUnavailable:
+        # E.g. the circuit opened while checking, the cached overview is still shown
+        cookies = None
     if cookies:
         markup = ReplyKeyboardMarkup([FREE_SEAT_MARKUP, ACCOUNT_MARKUP, EXTRA_MARKUP])
     else:
@@ -68,8 +91,39 @@ def check_login(update: Update, login_required=False):
     return cookies, markup
 
 
+def get_daytime_markup() -> list:
+    return [daytime['name'].title() for daytime in b.daytimes]
+
+
+class DaytimeFilter(MessageFilter):
+    """Matches the daytime buttons, the daytimes are only loaded when the first message arrives."""
+    def filter(self, message) -> bool:
+        return bool(message.text) and message.text in get_daytime_markup()
+
+
+def traced_handler(handler):
+    """Run a handler in a trace, which follows the update down to the upstream requests."""
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        with trace(f'handler.{handler.__name__}',
+                   update_id=update.update_id,
+                   chat_id=update.effective_chat.id if update.effective_chat else None):
+            with user_context(update.effective_user.id if update.effective_user else None):
+                return handler(update, context)
+    return wrapper
+
+
+class TracedBot(ExtBot):
+    """Records every call of the Telegram API as span of the current trace."""
+    def _post(self, endpoint: str, *args, **kwargs):
+        with span(f'telegram.{endpoint}'):
+            return super()._post(endpoint, *args, **kwargs)
+
+
+@traced_handler
 def start(update: Update, context: CallbackContext):
     update.message.reply_chat_action(ChatAction.TYPING)
+    remember_chat(update)
     cookies, markup = check_login(update)
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text="Willkommen beim KIT-Sitzplatzreservierungsbot!\n" +
@@ -78,6 +132,7 @@ def start(update: Update, context: CallbackContext):
                              reply_markup=markup)
 
 
+@traced_handler
 def day_selected(update: Update, context: CallbackContext):
     update.message.reply_chat_action(ChatAction.TYPING)
     text = update.message.text
@@ -86,21 +141,22 @@ def day_selected(update: Update, context: CallbackContext):
                 2 if text == 'In 2 Tagen' else \
                 3
 
-    redis.set(get_user_key(update, 'day_selected'), day_delta)
+    get_user_cache().set(get_user_key(update, 'day_selected'), day_delta)
     context.bot.send_message(chat_id=update.effective_chat.id, text='Welche Zeit?', parse_mode='HTML',
-                             reply_markup=ReplyKeyboardMarkup([[d] for d in DAYTIME_MARKUP]))
+                             reply_markup=ReplyKeyboardMarkup([[d] for d in get_daytime_markup()]))
     return TIME
 
 
+@traced_handler
 def time_selected(update: Update, context: CallbackContext):
-    day_value = redis.get(get_user_key(update, 'day_selected'))
+    day_value = get_user_cache().get(get_user_key(update, 'day_selected'))
     if day_value is None:
         cookies, markup = check_login(update)
         context.bot.send_message(chat_id=update.effective_chat.id, text='Wähle zuerst einen Tag aus.', parse_mode='HTML',
                                  reply_markup=markup)
         return
     day_delta = int(day_value)
-    redis.delete(get_user_key(update, 'day_selected'))
+    get_user_cache().delete(get_user_key(update, 'day_selected'))
     cookies, markup = check_login(update)
     text = update.message.text
     daytime = -1
@@ -111,32 +167,22 @@ def time_selected(update: Update, context: CallbackContext):
 
     try:
         date = datetime.datetime.today() + datetime.timedelta(days=day_delta)
-        bookings = b.search_bookings(start_day=date,
-                                     daytimes=[daytime])
-        update.message.reply_chat_action(ChatAction.TYPING)
-        grouped = group_bookings(b, bookings, b.areas)
-        msg = f'<b>{date.strftime(DATE_FORMAT)}</b>\n'
-        for daytime, rooms in grouped.items():
-            if rooms:
-                daytime_str = b.daytimes[daytime]["name"].title()
-                msg += f'<pre>{daytime_str}</pre>\n'
-                for room, seats in rooms.items():
-                    free_seats = [seat for seat in seats if seat['state'] == State.FREE]
-                    if len(free_seats) > 0:
-                        cached = len(free_seats) > 0 and free_seats[0]['cached']
-                        msg += f'<i>{room}</i>' if cached else room
-                        msg += f': {len(free_seats)}/{len(seats)}'
-                        if len(free_seats) <= 3:
-                            msg += ' (' + ', '.join(
-                                [format_seat_command(day_delta, daytime, s) for s in free_seats]) + ')'
-                        else:
-                            area = seats[0]['area']
-                            msg += f' /B{day_delta}_{int(daytime)}_{area}'
-                        msg += '\n'
-                msg += '\n'
+        # Read the version before rendering, so a grid refreshed meanwhile can only make the render newer
+        version = get_room_entries_version(date, b.areas.keys())
+        render_key = get_render_key('overview', date, day_delta, daytime, version) if version else None
+        cached_msg = cache.get(render_key) if render_key else None
+        count_cache('render_overview', 'stale' if not render_key else 'hit' if cached_msg else 'miss')
+        if cached_msg:
+            msg = cached_msg.decode()
+        else:
+            msg = render_overview(date, day_delta, daytime)
+            if render_key:
+                cache.set(render_key, msg, ex=RENDER_EXPIRY)
     except Exception as e:
         msg = 'Leider ist ein Fehler aufgetreten:\n' + str(e) + '\n'
         msg += traceback.format_exc()
+    if b.circuit.is_open:
+        msg += '\n<i>Die Bibliothek ist gerade nicht erreichbar, die Angaben können veraltet sein.</i>'
     if server_notice:
         msg += f'\n<i>{server_notice}</i>'
     context.bot.send_message(chat_id=update.effective_chat.id, text=msg, parse_mode='HTML',
@@ -144,10 +190,121 @@ def time_selected(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
+@traced('render_overview')
+def render_overview(date: datetime.datetime, day_delta: int, daytime: int) -> str:
+    msg = f'<b>{date.strftime(DATE_FORMAT)}</b>\n'
+    lines = ''
+    summary = b.get_seat_summary(date, daytime)
+    for area, entry in summary.items():
+        if entry.free > 0:
+            room = b.areas[area]
+            lines += f'<i>{room}</i>' if entry.cached else room
+            lines += f': {entry.free}/{entry.total}'
+            if entry.free <= 3:
+                lines += ' (' + ', '.join(
+                    [format_seat_command(day_delta, daytime, area, room_id, seat)
+                     for seat, room_id in entry.seats]) + ')'
+            else:
+                lines += f' /B{day_delta}_{int(daytime)}_{area}'
+            lines += '\n'
+    if summary:
+        daytime_str = b.daytimes[daytime]["name"].title()
+        msg += f'<pre>{daytime_str}</pre>\n' + lines + '\n'
+    return msg
+
+
+def render_seat_markup(date: datetime.datetime, day_delta, daytime, area) -> list:
+    index, cached = b.get_seat_index(date, area)
+    free_seats = index.free_seats(daytime) if index.has_daytime(daytime) else []
+    seat_markup = []
+    row_count = math.ceil(len(free_seats) / 3)
+    for i in range(0, row_count):
+        row = [format_seat_command(day_delta, daytime, area, room_id, seat) for seat, room_id in
+               free_seats[i * 3: (i + 1) * 3]]
+        seat_markup.append(row)
+    return seat_markup
+
+
+def book_batch(update: Update, values: dict):
+    """/BT{day}_... books a seat at all daytimes of a day, /BS{daytime}_... at a daytime of all days"""
+    cookies, markup = check_login(update, login_required=True)
+    if not cookies:
+        update.message.reply_text('Zuerst musst du dich einloggen. Klicke dazu unten auf Login.',
+                                  reply_markup=markup)
+        return
+    number = int(values['number'])
+    seat = values['seat'].replace('_', ' ')
+    if values['kind'] == 'T':
+        slots = [(number, daytime) for daytime in range(len(b.daytimes))]
+    elif number < len(b.daytimes):
+        slots = [(day_delta, number) for day_delta in range(len(FREE_SEAT_MARKUP))]
+    else:
+        update.message.reply_text('Unbekannte Tageszeit', reply_markup=markup)
+        return
+    # The library allows one seat per daytime, those already booked, e.g. the one the batch was offered
+    # after, would only fail
+    reserved = b.get_reserved_slots(update.message.from_user.id, cookies)
+    skipped = [slot for slot in slots if slot in reserved]
+    slots = [slot for slot in slots if slot not in reserved]
+    if not slots:
+        update.message.reply_text('Zu diesen Zeiten hast du schon überall einen Platz gebucht.', reply_markup=markup)
+        return
+    targets = [{'day_delta': day_delta, 'daytime': daytime, 'room': values['room'],
+                'room_id': values['room_id'], 'seat': seat} for day_delta, daytime in slots]
+    results = b.book_seats(update.message.from_user.id, targets, cookies)
+
+    lines = []
+    for target, (success, msg) in zip(targets, results):
+        date = datetime.datetime.today() + datetime.timedelta(days=target['day_delta'])
+        when = f"{date.strftime(DATE_FORMAT)} {b.daytimes[target['daytime']]['name'].title()}"
+        lines.append(f'✅ {when}' if success else f'❌ {when}' + (f": {msg.strip()}" if msg else ''))
+    booked = sum(success for success, _ in results)
+    msg = f'{booked} von {len(targets)} Buchungen erfolgreich\nOrt: {b.areas[values["room"]]}, Platz {seat}\n\n'
+    msg += '\n'.join(lines)
+    if skipped:
+        times = 'Zeit' if len(skipped) == 1 else 'Zeiten'
+        msg += f'\n\n{len(skipped)} {times} übersprungen, dort hast du schon einen Platz.'
+    update.message.reply_text(msg, reply_markup=markup)
+
+
+def cancel_batch(update: Update, day: str|None):
+    """/CA cancels all reservations, /CD{YYYYMMDD} those of a day"""
+    cookies, markup = check_login(update, login_required=True)
+    if not cookies:
+        update.message.reply_text('Zuerst musst du dich einloggen. Klicke dazu unten auf Login.',
+                                  reply_markup=markup)
+        return
+    if day:
+        day = f'{day[:4]}-{day[4:6]}-{day[6:]}'
+    results = b.cancel_reservations(update.message.from_user.id, cookies, day=day)
+    if results is None:
+        msg = 'Es gab einen Fehler beim Öffnen der Reservierungen'
+    elif not results:
+        msg = 'Keine Reservierungen zum Löschen gefunden.'
+    else:
+        cancelled = sum(success for _, success in results)
+        msg = f'{cancelled} von {len(results)} Reservierungen gelöscht.'
+        failed = [r for r, success in results if not success]
+        if failed:
+            msg += '\nFehlgeschlagen:\n' + '\n'.join(
+                f"{r['date']} {r.get('daytime', '')} {r['room']}: Platz {r['seat']} /C{r['id']}" for r in failed)
+    update.message.reply_text(msg, reply_markup=markup)
+
+
+@traced_handler
 def booking(update: Update, context: CallbackContext):
     global b
     update.message.reply_chat_action(ChatAction.TYPING)
     text = update.message.text
+    m = re.match('^/B(?P<kind>[TS])(?P<number>[0-9])_(?P<room>[0-9]+)_(?P<room_id>[A-Z0-9]+)_(?P<seat>[A-Z0-9_]+)$',
+                 text)
+    if m:
+        book_batch(update, m.groupdict())
+        return
+    m = re.match('^/C(A|D(?P<day>[0-9]{8}))$', text)
+    if m:
+        cancel_batch(update, m.group('day'))
+        return
     m = re.match(
         '^/B(?P<day_delta>[0-9])_(?P<daytime>[0-9])_(?P<room>[0-9]+)_(?P<room_id>[A-Z0-9]+)_(?P<seat>[A-Z0-9_]+)$',
         text)
@@ -160,8 +317,14 @@ def booking(update: Update, context: CallbackContext):
             success, msg = b.book_seat(user_id=user_id,
                                          cookies=cookies,
                                          **values)
+            if success:
+                # Offer the same seat at the other times, booked with one command
+                batch_suffix = f"{values['room']}_{values['room_id']}_{values['seat'].replace(' ', '_')}"
+                msg = (msg if msg else 'Erfolgreich gebucht!') + \
+                      f"\n\nGanzer Tag: /BT{values['day_delta']}_{batch_suffix}" \
+                      f"\nDiese Zeit an allen Tagen: /BS{values['daytime']}_{batch_suffix}"
             update.message.reply_text(
-                (msg if msg else 'Erfolgreich gebucht!') if success else
+                msg if success else
                 'Buchung ist leider fehlgeschlagen.' + (f'\nFehler: {msg}' if msg else ''),
                 reply_markup=markup)
         else:
@@ -171,17 +334,18 @@ def booking(update: Update, context: CallbackContext):
         m = re.match('^/B(?P<day_delta>[0-9])_(?P<daytime>[0-9])_(?P<room>[0-9]+)$', text)
         if m:
             values = m.groupdict()
-            bookings = b.search_bookings(
-                start_day=datetime.datetime.today() + datetime.timedelta(days=int(values['day_delta'])),
-                state=State.FREE,
-                daytimes=[int(values['daytime'])],
-                areas=[int(values['room'])])
-            seat_markup = []
-            row_count = math.ceil(len(bookings) / 3)
-            for i in range(0, row_count):
-                row = [format_seat_command(values['day_delta'], values['daytime'], b) for b in
-                       bookings[i * 3: (i + 1) * 3]]
-                seat_markup.append(row)
+            day_delta, daytime, area = int(values['day_delta']), int(values['daytime']), values['room']
+            date = datetime.datetime.today() + datetime.timedelta(days=day_delta)
+            version = get_room_entries_version(date, [area])
+            render_key = get_render_key('seats', date, day_delta, daytime, area, version) if version else None
+            cached_markup = cache.get(render_key) if render_key else None
+            count_cache('render_seats', 'stale' if not render_key else 'hit' if cached_markup else 'miss')
+            if cached_markup:
+                seat_markup = json.loads(cached_markup)
+            else:
+                seat_markup = render_seat_markup(date, day_delta, daytime, area)
+                if render_key:
+                    cache.set(render_key, json.dumps(seat_markup), ex=RENDER_EXPIRY)
             seat_markup.append(['Abbrechen'])
             context.bot.send_message(chat_id=update.effective_chat.id, text='Wähle einen Sitzplatz', parse_mode='HTML',
                                      reply_markup=ReplyKeyboardMarkup(seat_markup))
@@ -204,6 +368,7 @@ def booking(update: Update, context: CallbackContext):
                                          reply_markup=FREE_SEAT_MARKUP)
 
 
+@traced_handler
 def reservations(update: Update, context: CallbackContext):
     #clear_state(update)
     update.message.reply_chat_action(ChatAction.TYPING)
@@ -234,6 +399,8 @@ def reservations(update: Update, context: CallbackContext):
                     msg += '\n'
                 if cur_date != last_date:
                     msg += f'<b>{cur_date}</b>\n'
+                    if 'day' in booking:
+                        msg += f"Alle an diesem Tag löschen: /CD{booking['day'].replace('-', '')}\n"
                 if 'daytime' in booking:
                     daytime = booking["daytime"]
                     msg += f'<pre>{daytime}</pre>\n'
@@ -241,15 +408,21 @@ def reservations(update: Update, context: CallbackContext):
                        f"Platz {booking['seat']} . Löschen: " \
                        f"/C{booking['id']}\n"
                 last_date = cur_date
+            if len(bookings) > 1:
+                msg += '\nAlle löschen: /CA\n'
             pin_message = True
         else:
             msg = 'Du hast aktuell keine Reservierungen.'
         sent_message = update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=markup)
-        context.bot.unpin_all_chat_messages(chat_id=sent_message.chat_id)
-        sent_message.pin(disable_notification=True)
+
+        def pin():
+            context.bot.unpin_all_chat_messages(chat_id=sent_message.chat_id)
+            sent_message.pin(disable_notification=True)
+        # Only the latest list is pinned if the user asks several times in a row
+        outbox.submit(sent_message.chat_id, pin, coalesce_key='pin')
     else:
         if captcha_enabled:
-            redis.set(get_user_key(update, 'captcha_next'), RESERVATIONS)
+            get_user_cache().set(get_user_key(update, 'captcha_next'), RESERVATIONS)
             return show_captcha(update, context)
         else:
             update.message.reply_text('Um dich einzuloggen musst du leider deine Kontodaten eingeben.\n'
@@ -260,6 +433,7 @@ def reservations(update: Update, context: CallbackContext):
             return USERNAME
 
 
+@traced_handler
 def extras(update: Update, context: CallbackContext):
     #clear_state(update)
     update.message.reply_chat_action(ChatAction.TYPING)
@@ -316,10 +490,15 @@ def extras(update: Update, context: CallbackContext):
                                   parse_mode=ParseMode.MARKDOWN_V2)
 
 
-def format_seat_command(day_delta, daytime: int, booking:dict, reserved=False):
+def format_seat_command(day_delta, daytime: int, area, room_id, seat, reserved=False):
     prefix = 'C' if reserved else 'B'
-    seat = booking['seat']['seat'].replace(' ', '_')
-    return f"/{prefix}{day_delta}_{int(daytime)}_{booking['area']}_{booking['seat']['room_id']}_{seat}"
+    seat = seat.replace(' ', '_')
+    return f"/{prefix}{day_delta}_{int(daytime)}_{area}_{room_id}_{seat}"
+
+
+def get_render_key(kind: str, date: datetime.datetime, *parts):
+    """Key for rendered output shared between users, parts should include the grid version."""
+    return f'render:{kind}:{date.strftime("%y-%m-%d")}:' + ':'.join(str(p) for p in parts)
 
 
 def get_user_key(update: Update, description: str):
@@ -327,14 +506,15 @@ def get_user_key(update: Update, description: str):
     return f'temp:{description}:{user_id}'
 
 
+@traced_handler
 def login(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     creds = get_user_creds(user_id)
     if creds:
         if captcha_enabled:
-            photo, cookies = b.get_captcha()
+            photo, cookies = b.get_captcha(user_id)
             if photo:
-                redis.set(get_user_key(update, 'login_cookies'), pickle.dumps(cookies))
+                get_user_cache().set(get_user_key(update, 'login_cookies'), pickle.dumps(cookies))
                 msg = 'Gib nun die Zeichen im Captcha ein.\nWenn du dich neu einloggen willst, klicke unten auf den Knopf.'
                 markup = [NEW_LOGIN_MARKUP, CANCEL_MARKUP]
                 update.message.reply_photo(photo=photo,
@@ -351,6 +531,9 @@ def login(update: Update, context: CallbackContext):
                 update.message.reply_text("Du bist bereits eingeloggt", reply_markup=markup)
                 return ConversationHandler.END
 
+    if captcha_enabled:
+        # Ready by the time the password is entered
+        b.prefetch_captcha(user_id)
     update.message.reply_text('Um dich einzuloggen musst du leider deine Kontodaten eingeben.\n'
                               'Es ist (soweit ich weiß) noch kein <a href="https://oauth.net/">Oauth</a> für die Sitzplatzreservierung implementiert.\n'
                               'Gib nun die <b>Kontonummer</b> von deinem Bibliotheks-Konto ein:',
@@ -359,15 +542,19 @@ def login(update: Update, context: CallbackContext):
     return USERNAME
 
 
+@traced_handler
 def login_username(update: Update, context: CallbackContext):
     text = update.message.text
     if text in CANCEL_MARKUP:
         return login_cancel(update, context)
-    redis.set(get_user_key(update, 'login_username'), text)
+    get_user_cache().set(get_user_key(update, 'login_username'), text)
+    if captcha_enabled:
+        b.prefetch_captcha(update.message.from_user.id)
     update.message.reply_text('Gib jetzt das <b>Passwort</b> von deinem Bibliotheks-Konto ein:', reply_markup=ReplyKeyboardMarkup([CANCEL_MARKUP]), parse_mode=ParseMode.HTML)
     return PASSWORD
 
 
+@traced_handler
 def login_password(update: Update, context: CallbackContext):
     text = update.message.text
     if text in CANCEL_MARKUP:
@@ -375,17 +562,18 @@ def login_password(update: Update, context: CallbackContext):
     else:
         update.message.delete()
     update.message.reply_chat_action(ChatAction.TYPING)
-    redis.set(get_user_key(update, 'login_password'), text)
+    get_user_cache().set(get_user_key(update, 'login_password'), text)
     if captcha_enabled:
         return show_captcha(update, context)
     else:
         return login_captcha(update, context)
 
 
+@traced_handler
 def show_captcha(update: Update, context: CallbackContext):
-    photo, cookies = b.get_captcha()
+    photo, cookies = b.get_captcha(update.message.from_user.id)
     if photo:
-        redis.set(get_user_key(update, 'login_cookies'), pickle.dumps(cookies))
+        get_user_cache().set(get_user_key(update, 'login_cookies'), pickle.dumps(cookies))
         msg = 'Gib nun die Zeichen im Captcha ein'
         markup = [NEW_LOGIN_MARKUP, CANCEL_MARKUP]
         update.message.reply_photo(photo=photo,
@@ -398,11 +586,13 @@ def show_captcha(update: Update, context: CallbackContext):
         return None
 
 
+@traced_handler
 def login_captcha(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     creds = get_user_creds(user_id)
     update.message.reply_chat_action(ChatAction.TYPING)
 
+    user_cache = get_user_cache()
     redis_username_key = get_user_key(update, 'login_username')
     redis_password_key = get_user_key(update, 'login_password')
 
@@ -414,9 +604,9 @@ def login_captcha(update: Update, context: CallbackContext):
         update.message.reply_text('Gib nun die Kontonummer von deinem Bibliotheks-Konto ein:',
                                   reply_markup=ReplyKeyboardMarkup([CANCEL_MARKUP]))
         return USERNAME
-    elif redis.exists(redis_username_key) and redis.exists(redis_password_key):
-        username = redis.get(redis_username_key).decode()
-        password = redis.get(redis_password_key).decode()
+    elif user_cache.exists(redis_username_key) and user_cache.exists(redis_password_key):
+        username = user_cache.get(redis_username_key).decode()
+        password = user_cache.get(redis_password_key).decode()
     elif creds:
         username = creds['user']
         password = creds['password']
@@ -425,7 +615,7 @@ def login_captcha(update: Update, context: CallbackContext):
         update.message.reply_text('Gib nun die Kontonummer von deinem Bibliotheks-Konto ein:',
                                   reply_markup=ReplyKeyboardMarkup([CANCEL_MARKUP]))
         return USERNAME
-    cookies_pickle = redis.get(get_user_key(update, 'login_cookies'))
+    cookies_pickle = user_cache.get(get_user_key(update, 'login_cookies'))
     cookies = pickle.loads(cookies_pickle) if cookies_pickle else None
     captcha = update.message.text
     clear_state(update)
@@ -438,9 +628,10 @@ def login_captcha(update: Update, context: CallbackContext):
                       login_required=True)
     if cookies:
         next_key = get_user_key(update, 'captcha_next')
-        next_val = redis.get(next_key)
+        next_val = user_cache.get(next_key)
         next_step = int(next_val) if next_val else None
-        redis.delete(next_key)
+        user_cache.delete(next_key)
+        remember_chat(update)
         if next_step == RESERVATIONS:
             reservations(update, context)
         else:
@@ -454,6 +645,7 @@ def login_captcha(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
+@traced_handler
 def login_cancel(update: Update, context: CallbackContext):
     clear_state(update)
     update.message.reply_text('Login abgebrochen',
@@ -461,6 +653,7 @@ def login_cancel(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
+@traced_handler
 def cancel_command(update: Update, context: CallbackContext):
     cookies, markup = check_login(update)
     clear_state(update)
@@ -468,6 +661,30 @@ def cancel_command(update: Update, context: CallbackContext):
                               reply_markup=markup)
 
 
+@traced_handler
+def broadcast(update: Update, context: CallbackContext):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return unknown_command(update, context)
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        update.message.reply_text('Benutzung: /broadcast <Nachricht>')
+        return
+    chat_ids = [int(chat_id) for chat_id in cache.hgetall('chats')]
+    for chat_id in chat_ids:
+        outbox.submit(chat_id,
+                      functools.partial(context.bot.send_message, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML),
+                      # Only this broadcast, a second one is queued after it instead of replacing it
+                      coalesce_key=f'broadcast:{update.update_id}')
+    update.message.reply_text(f'Nachricht an {len(chat_ids)} Chats eingereiht, '
+                              f'das Senden dauert etwa {math.ceil(len(outbox) * outbox.global_interval / 60)} Minuten.')
+
+
+def remember_chat(update: Update):
+    """Chats reached by /broadcast"""
+    cache.hset('chats', str(update.effective_chat.id), int(time.time()))
+
+
+@traced_handler
 def unknown_command(update: Update, context: CallbackContext):
     if update.message.from_user.is_bot:
         return
@@ -475,53 +692,97 @@ def unknown_command(update: Update, context: CallbackContext):
     update.message.reply_text('Unbekannter Befehl. Benutze die Buttons unten, um Funktionen aufzurufen.',
                               reply_markup=markup)
 
-dispatcher.add_handler(CommandHandler('start', start))
-day_time_selection = ConversationHandler(
-    entry_points=[MessageHandler(Filters.text(FREE_SEAT_MARKUP), day_selected)],
-    states={
-        TIME: [MessageHandler(Filters.text(DAYTIME_MARKUP), time_selected)],
-    },
-    #fallbacks=[MessageHandler(Filters.text, cancel_command)],
-    fallbacks=[],
-    allow_reentry=True
-)
-
-maintenance_notice = os.environ.get('MAINTENANCE_NOTICE')
-if maintenance_notice:
-    def out_of_order(update: Update, context: CallbackContext):
-        cookies, markup = check_login(update)
-        update.message.reply_text(maintenance_notice.replace('\\n', '\n'),
-                                  parse_mode=ParseMode.HTML,
-                                  reply_markup=markup)
-    dispatcher.add_handler(MessageHandler(Filters.text('Zeiten'), extras))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.text('Zeiten') | Filters.command, out_of_order))
-else:
-    dispatcher.add_handler(day_time_selection)
-    #dispatcher.add_handler(MessageHandler(Filters.text(FREE_SEAT_MARKUP) & (~Filters.command), overview))
-    dispatcher.add_handler(MessageHandler(Filters.command, booking))
-    #dispatcher.add_handler(MessageHandler(Filters.text(ACCOUNT_MARKUP), reservations))
-    dispatcher.add_handler(MessageHandler(Filters.text(EXTRA_MARKUP), extras))
-
-    login_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(Filters.text(LOGIN_MARKUP), login),
-                      MessageHandler(Filters.text(ACCOUNT_MARKUP), reservations)],
+
+def add_handlers(dispatcher):
+    dispatcher.add_handler(CommandHandler('start', start))
+    dispatcher.add_handler(CommandHandler('broadcast', broadcast))
+    day_time_selection = ConversationHandler(
+        name='day_time_selection',
+        entry_points=[MessageHandler(Filters.text(FREE_SEAT_MARKUP), day_selected)],
         states={
-            USERNAME: [MessageHandler(Filters.text & ~Filters.command, login_username)],
-            PASSWORD: [MessageHandler(Filters.text & ~Filters.command, login_password)],
-            CAPTCHA: [MessageHandler(Filters.text & ~Filters.command, login_captcha)],
-            RESERVATIONS: [MessageHandler(Filters.text & ~Filters.command, reservations)],
+            TIME: [MessageHandler(DaytimeFilter(), time_selected)],
         },
-        fallbacks=[MessageHandler(Filters.text(CANCEL_MARKUP), login_cancel)]
+        #fallbacks=[MessageHandler(Filters.text, cancel_command)],
+        fallbacks=[],
+        allow_reentry=True
     )
-    dispatcher.add_handler(login_conv_handler)
 
-    dispatcher.add_handler(MessageHandler(Filters.text(CANCEL_MARKUP), cancel_command))
-    dispatcher.add_handler(MessageHandler(~Filters.text(FREE_SEAT_MARKUP)
-                                          & ~Filters.text(ACCOUNT_MARKUP)
-                                          & ~Filters.text(LOGIN_MARKUP)
-                                          & ~Filters.text(EXTRA_MARKUP)
-                                          & ~Filters.command, unknown_command))
+    maintenance_notice = os.environ.get('MAINTENANCE_NOTICE')
+    if maintenance_notice:
+        @traced_handler
+        def out_of_order(update: Update, context: CallbackContext):
+            cookies, markup = check_login(update)
+            update.message.reply_text(maintenance_notice.replace('\\n', '\n'),
+                                      parse_mode=ParseMode.HTML,
+                                      reply_markup=markup)
+        dispatcher.add_handler(MessageHandler(Filters.text('Zeiten'), extras))
+        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.text('Zeiten') | Filters.command, out_of_order))
+    else:
+        dispatcher.add_handler(day_time_selection)
+        #dispatcher.add_handler(MessageHandler(Filters.text(FREE_SEAT_MARKUP) & (~Filters.command), overview))
+        dispatcher.add_handler(MessageHandler(Filters.command, booking))
+        #dispatcher.add_handler(MessageHandler(Filters.text(ACCOUNT_MARKUP), reservations))
+        dispatcher.add_handler(MessageHandler(Filters.text(EXTRA_MARKUP), extras))
+
+        login_conv_handler = ConversationHandler(
+            name='login',
+            entry_points=[MessageHandler(Filters.text(LOGIN_MARKUP), login),
+                          MessageHandler(Filters.text(ACCOUNT_MARKUP), reservations)],
+            states={
+                USERNAME: [MessageHandler(Filters.text & ~Filters.command, login_username)],
+                PASSWORD: [MessageHandler(Filters.text & ~Filters.command, login_password)],
+                CAPTCHA: [MessageHandler(Filters.text & ~Filters.command, login_captcha)],
+                RESERVATIONS: [MessageHandler(Filters.text & ~Filters.command, reservations)],
+            },
+            fallbacks=[MessageHandler(Filters.text(CANCEL_MARKUP), login_cancel)]
+        )
+        dispatcher.add_handler(login_conv_handler)
+
+        dispatcher.add_handler(MessageHandler(Filters.text(CANCEL_MARKUP), cancel_command))
+        dispatcher.add_handler(MessageHandler(~Filters.text(FREE_SEAT_MARKUP)
+                                              & ~Filters.text(ACCOUNT_MARKUP)
+                                              & ~Filters.text(LOGIN_MARKUP)
+                                              & ~Filters.text(EXTRA_MARKUP)
+                                              & ~Filters.command, unknown_command))
+
+
+def main():
+    request_kwargs = {
+        'con_pool_size': 8
+    }
+    proxy = os.environ.get('PROXY')
+    if proxy:
+        request_kwargs['proxy_url'] = proxy
+    bot = TracedBot(token=os.environ.get('BOT_TOKEN'), request=Request(**request_kwargs))
+    if BOT_ROLE == 'ingress':
+        start_metrics_server()
+        logging.info(f'Ingress started in {time.perf_counter() - START_TIME:.2f} seconds')
+        run_ingress(bot, install_stop_handler())
+        return
+    elif BOT_ROLE == 'worker':
+        stop = install_stop_handler()
+        dispatcher = Dispatcher(bot, None, workers=0)
+        add_handlers(dispatcher)
+        share_conversations(dispatcher)
+        start_metrics_server()
+        threading.Thread(target=b.load_metadata, name='load-metadata', daemon=True).start()
+        # Keep areas and daytimes in redis fresh, so starting workers never have to load them
+        threading.Thread(target=run_as_leader, name='refresh-metadata', daemon=True,
+                         args=('refresh-metadata', b.reload_metadata, METADATA_REFRESH_INTERVAL, stop)).start()
+        logging.info(f'Worker started in {time.perf_counter() - START_TIME:.2f} seconds')
+        Worker(dispatcher, stop).run()
+        return
+
+    updater = Updater(bot=bot)
+    add_handlers(updater.dispatcher)
+    start_metrics_server()
+
+    updater.start_polling()
+    # Warm up in the background, updates can already be answered from the snapshot meanwhile
+    threading.Thread(target=b.load_metadata, name='load-metadata', daemon=True).start()
+    logging.info(f'Bot started in {time.perf_counter() - START_TIME:.2f} seconds')
+    updater.idle()
 
-updater.start_polling()
-updater.idle()
 
+if __name__ == '__main__':
+    main()